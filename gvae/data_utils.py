@@ -10,14 +10,14 @@ import os
 import re
 import nltk
 import numpy as np
-import h5py
 
 import matplotlib.pyplot as plt
 from sklearn.decomposition import PCA
 
-from vis_vae import VisVAE, get_rules, get_specs
+from vis_vae import VisVAE, get_rules
 from vis_grammar import VisGrammar
-from train import MAX_LEN
+from settings import MAX_LEN
+from dataset import write_dataset, read_onehot
 
 # extract CFG rules from the dataset
 def extract_rules(inputfile, outputfile):
@@ -56,7 +56,11 @@ def generate_datasets(inputfile, rulesfile, outputdir):
     with open(inputfile, 'r') as inputs:
         for line in inputs:
             rules = []
-            spec = json.loads(line)
+            try:
+                spec = json.loads(line)
+            except Exception as e:
+                print(line, e)
+                continue
             get_rules(spec, 'root', rules)
             data.append(rules)
 
@@ -71,21 +75,16 @@ def generate_datasets(inputfile, rulesfile, outputdir):
     for i, r in enumerate(rules):
         rule2index[r] = i
 
-    one_hot = np.zeros((len(data), MAX_LEN, len(rules)), dtype=np.float32)
+    # production indices padded with the last rule, 'Nothing -> None'; the
+    # training code expands them to one-hot a batch at a time
+    indices = np.full((len(data), MAX_LEN), len(rules) - 1, dtype=np.int16)
     for i, sentence_rules in enumerate(data):
-        indices = [rule2index[r] for r in sentence_rules]
-        one_hot[i][np.arange(len(indices)), indices] = 1
-        one_hot[i][np.arange(len(indices), MAX_LEN), -1] = 1
+        indices[i, :len(sentence_rules)] = [rule2index[r] for r in sentence_rules]
 
-    split = int(0.1 * one_hot.shape[0])
-    with h5py.File(outputdir + 'test.h5', 'w') as f:
-        f.create_dataset('data', data=one_hot[0:split])
-    
-    with h5py.File(outputdir + 'train.h5', 'w') as f:
-        f.create_dataset('data', data=one_hot[split:])
-    
-    with h5py.File(outputdir + 'dev.h5', 'w') as f:
-        f.create_dataset('data', data=one_hot[0:1000])
+    split = int(0.1 * indices.shape[0])
+    write_dataset(outputdir + 'test.h5', indices[0:split], len(rules))
+    write_dataset(outputdir + 'train.h5', indices[split:], len(rules))
+    write_dataset(outputdir + 'dev.h5', indices[0:1000], len(rules))
 
 # test the accuracy of the model
 def test_vaemodel(rulesfile, modelsave, datafile):
@@ -98,9 +97,7 @@ def test_vaemodel(rulesfile, modelsave, datafile):
     m = re.search(r'_L(\d+)_', modelsave)
     visvae = VisVAE(modelsave, rules, MAX_LEN, int(m.group(1)))
 
-    h5f = h5py.File(datafile, 'r')
-    data = h5f['data'][:]
-    h5f.close()
+    data = read_onehot(datafile)
     print(data.shape)
 
     output = visvae.vae.autoencoder.predict(data)
@@ -119,7 +116,7 @@ def visualize_embedding(z, specs, figpath='./'):
     channel2int = {}
     channelmark2int = {}
 
-    embeddings = np.load(z)
+    embeddings = np.load(z, mmap_mode='r')
     channels = []
     marks = []
     channelmarks = []
@@ -208,8 +205,15 @@ if __name__ == '__main__':
     ## 2. generate the traning and testing datasets
     generate_datasets('../sourcedata/vegaspecs-processed.txt', 'trainingdata/rules-cfg.txt', 'trainingdata/')
 
+    ## 1-2. alternatively, on large corpora, both steps in one parallel pass that also drops
+    ## specs with more than MAX_LEN rules and lists rejected lines in trainingdata/rejected.txt
+    # python ingest.py ../sourcedata/vegaspecs-processed.txt trainingdata/
+
     ## 3. train the model: see train.py
     # e.g., python train.py --hidden 256 --dense 256 --conv1 8 3 --conv3 8 3 --conv3 8 3 --latent 20
+    # on CPUs, tune --intra-threads, --inter-threads, --workers and --prefetch with the per-epoch numbers of --perf-log
+    # or train several configurations side by side and compare them in trained/sweep/results.csv, e.g.,
+    # python sweep.py sweep.json --jobs 4, with {"grid": {"latent": [2, 20], "hidden": [128, 256]}, "defaults": {"epochs": 50}} in sweep.json
 
     ## 4. test the model performance
     test_vaemodel('trainingdata/rules-cfg.txt', 'trained/vae_H256_D256_C444_333_L20_B200.hdf5', 'trainingdata/test.h5')
@@ -233,6 +237,9 @@ if __name__ == '__main__':
     #     outputs.write('{"input": [' + ','.join(inputspec) + '],')
     #     outputs.write('"output": [' + ','.join(outputspec) + ']}')
 
+    ## embed a whole corpus into a memory-mapped store (resumable; see embed.open_store and embed.read_specs)
+    # python embed.py ../sourcedata/vegaspecs-processed.txt trained/vae_H256_D256_C444_333_L20_B200.hdf5 trained/corpus
+
     ## visualize the embedding space
     # np.save('embeddings.npy', z)
     # visualize_embedding('embeddings.npy', inputspec, './')
\ No newline at end of file
@@ -0,0 +1,36 @@
+##################################################
+## Compact training datasets
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import h5py
+import numpy as np
+
+CHUNK_ROWS = 4096
+
+# store production index sequences (N x MAX_LEN, padded with the index of
+# 'Nothing -> None') as int16 in a chunked, compressed HDF5 file; at about 40
+# bytes per chart this is two orders of magnitude smaller than the one-hot data
+def write_dataset(filename, indices, num_rules):
+    indices = np.asarray(indices, dtype=np.int16)
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('indices', data=indices, chunks=(max(1, min(CHUNK_ROWS, indices.shape[0])), indices.shape[1]),
+            compression='gzip', shuffle=True)
+        f.attrs['num_rules'] = num_rules
+
+# one-hot data of a dataset file, either format; only for sets small enough to
+# fit in memory, e.g. for testing
+def read_onehot(filename):
+    with h5py.File(filename, 'r') as f:
+        if 'indices' in f:
+            return expand(f['indices'][:], int(f.attrs['num_rules']))
+        return f['data'][:]
+
+def expand(indices, num_rules):
+    return np.eye(num_rules, dtype=np.float32)[indices]
+
+def is_compact(filename):
+    with h5py.File(filename, 'r') as f:
+        return 'indices' in f
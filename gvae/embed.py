@@ -0,0 +1,160 @@
+##################################################
+## Offline corpus embedding
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import argparse
+import os
+import re
+import time
+import simplejson as json
+import numpy as np
+
+from vis_vae import get_rules
+from settings import MAX_LEN
+
+CHUNK = 4096
+
+# status of every row of an embedding store
+PENDING, DONE, REJECTED = 0, 1, 2
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Embed a spec corpus into a memory-mapped embedding store')
+
+    parser.add_argument('input', help='spec corpus, one VegaLite JSON spec per line')
+    parser.add_argument('model', help='trained model, e.g. trained/vae_H256_D256_C444_333_L20_B200.hdf5')
+    parser.add_argument('output', help='prefix of the store files: .z.npy, .offsets.npy, .status.npy and .json')
+    parser.add_argument('--rules', metavar='FILE', default='trainingdata/rules-cfg.txt')
+    parser.add_argument('--chunk', type=int, metavar='N', default=CHUNK, help='specs encoded per call')
+    parser.add_argument('--restart', action='store_true', help='discard an existing store instead of resuming it')
+
+    return parser.parse_args()
+
+# byte offset of the start of every line, plus the file size as the end of the
+# last; interface/neighbors.py reads the stores back with the same offsets
+def line_offsets(filename, block=16 * 2**20):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            offsets.append(position + newlines.astype(np.int64) + 1)
+            position += len(data)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+    return offsets
+
+# the store of an embedding run: z (rows x latent float32, NaN for rejected
+# specs), offsets (rows + 1 byte positions into the source file) and status (one
+# of PENDING, DONE, REJECTED per row), all memory-mapped, and meta describing the
+# source file and model they belong to
+def open_store(prefix, mode='r'):
+    with open(prefix + '.json', 'r') as inputs:
+        meta = json.load(inputs)
+    z = np.load(prefix + '.z.npy', mmap_mode=mode)
+    offsets = np.load(prefix + '.offsets.npy', mmap_mode='r')
+    status = np.load(prefix + '.status.npy', mmap_mode=mode)
+    return z, offsets, status, meta
+
+# the source lines of the given rows of a store
+def read_specs(source, offsets, rows):
+    specs = []
+    with open(source, 'rb') as f:
+        for row in rows:
+            f.seek(offsets[row])
+            specs.append(f.read(offsets[row + 1] - offsets[row]).decode('utf8').rstrip('\r\n'))
+    return specs
+
+def create_store(prefix, source, model, latent):
+    offsets = line_offsets(source)
+    rows = len(offsets) - 1
+    np.save(prefix + '.offsets.npy', offsets)
+    np.lib.format.open_memmap(prefix + '.z.npy', mode='w+', dtype=np.float32, shape=(rows, latent)).flush()
+    np.lib.format.open_memmap(prefix + '.status.npy', mode='w+', dtype=np.int8, shape=(rows,)).flush()
+
+    stat = os.stat(source)
+    meta = {'source': os.path.abspath(source), 'size': stat.st_size, 'mtime': stat.st_mtime,
+        'model': os.path.abspath(model), 'latent': latent, 'rows': rows}
+    # the metadata goes last, so a store without it is incomplete and recreated
+    with open(prefix + '.json', 'w') as outputs:
+        json.dump(meta, outputs)
+
+# reuse a store only if it was made from the same source file and model
+def resumable(prefix, source, model):
+    if not os.path.isfile(prefix + '.json'):
+        return False
+    with open(prefix + '.json', 'r') as inputs:
+        meta = json.load(inputs)
+    stat = os.stat(source)
+    return meta['source'] == os.path.abspath(source) and meta['size'] == stat.st_size \
+        and meta['mtime'] == stat.st_mtime and meta['model'] == os.path.abspath(model)
+
+# production indices of a spec line, or None if it cannot be encoded
+def spec_indices(line, rule2index, max_len):
+    try:
+        spec = json.loads(line)
+    except Exception:
+        return None
+    if not isinstance(spec, dict):
+        return None
+    rules = []
+    get_rules(spec, 'root', rules)
+    if len(rules) > max_len or any(r not in rule2index for r in rules):
+        return None
+    return [rule2index[r] for r in rules]
+
+# encode the pending rows of the store chunk by chunk; every chunk is flushed
+# before it is marked done, so an interrupted run continues where it stopped
+def embed(source, model, prefix, rulesfile, chunk=CHUNK, restart=False):
+    from vis_vae import VisVAE
+    from dataset import expand
+
+    with open(rulesfile, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+    rule2index = {r: i for i, r in enumerate(rules)}
+    latent = int(re.search(r'_L(\d+)_', model).group(1))
+
+    if restart or not resumable(prefix, source, model):
+        create_store(prefix, source, model, latent)
+    z, offsets, status, meta = open_store(prefix, mode='r+')
+
+    visvae = VisVAE(model, rules, MAX_LEN, latent)
+
+    pending = np.flatnonzero(status == PENDING)
+    print('%d of %d specs to embed' % (len(pending), meta['rows']))
+    start = time.time()
+    done = 0
+    for begin in range(0, len(pending), chunk):
+        rows = pending[begin:begin + chunk]
+        indices = np.full((len(rows), MAX_LEN), len(rules) - 1, dtype=np.int16)
+        valid = np.zeros(len(rows), dtype=bool)
+        for i, line in enumerate(read_specs(source, offsets, rows)):
+            spec = spec_indices(line, rule2index, MAX_LEN)
+            if spec is not None:
+                indices[i, :len(spec)] = spec
+                valid[i] = True
+
+        if valid.any():
+            z[rows[valid]] = visvae.vae.encoderMV.predict(expand(indices[valid], len(rules)))[0]
+        z[rows[~valid]] = np.nan
+        z.flush()
+        status[rows] = np.where(valid, DONE, REJECTED)
+        status.flush()
+
+        done += len(rows)
+        print('%d / %d, %.0f specs/s' % (done, len(pending), done / (time.time() - start)))
+
+    print('%d embedded, %d rejected' % (np.sum(status == DONE), np.sum(status == REJECTED)))
+
+def main():
+    args = get_arguments()
+    embed(args.input, args.model, args.output, args.rules, args.chunk, args.restart)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+##################################################
+## Parallel corpus ingestion
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import argparse
+import multiprocessing
+import os
+import time
+import simplejson as json
+import numpy as np
+
+from vis_vae import get_rules
+from dataset import write_dataset
+from settings import MAX_LEN
+
+CHUNK_BYTES = 4 * 2**20
+NOTHING_RULE = 'Nothing -> None'
+
+# a fixed rules vocabulary given with --rules, set in every worker
+vocabulary = None
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Build the rules file and training datasets from a spec corpus in one pass')
+
+    parser.add_argument('input', help='spec corpus, one VegaLite JSON spec per line')
+    parser.add_argument('outputdir', help='directory for rules-cfg.txt, rule-counts.txt, rejected.txt and the datasets')
+    parser.add_argument('--rules', metavar='FILE', default=None,
+        help='use this rules file instead of building one; specs with other rules are rejected')
+    parser.add_argument('--processes', type=int, metavar='N', default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk', type=int, metavar='MB', default=CHUNK_BYTES // 2**20,
+        help='size of the corpus pieces handed to the processes')
+    parser.add_argument('--max-len', type=int, metavar='N', default=MAX_LEN,
+        help='specs with more rules than this are dropped')
+
+    return parser.parse_args()
+
+# byte ranges of about chunk_bytes that start and end at line boundaries
+def split_file(filename, chunk_bytes):
+    size = os.path.getsize(filename)
+    ranges = []
+    with open(filename, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+def init_worker(rules):
+    global vocabulary
+    vocabulary = set(rules) if rules is not None else None
+
+# parse one byte range of the corpus; rules are numbered in order of appearance
+# within the range, and the caller maps them to the final vocabulary
+def ingest_chunk(args):
+    filename, start, end, max_len = args
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+    if lines and not lines[-1]:
+        lines.pop()
+
+    local = {}
+    counts = []
+    sequences = []
+    rejected = []
+    for i, line in enumerate(lines):
+        try:
+            line = line.decode('utf8').rstrip('\r')
+        except UnicodeDecodeError as e:
+            rejected.append((i, 'not UTF-8: %s' % e, line.decode('utf8', 'replace')))
+            continue
+        if not line.strip():
+            continue
+        try:
+            spec = json.loads(line)
+        except Exception as e:
+            rejected.append((i, 'invalid JSON: %s' % e, line))
+            continue
+        if not isinstance(spec, dict):
+            rejected.append((i, 'not a JSON object', line))
+            continue
+
+        rules = []
+        get_rules(spec, 'root', rules)
+        if len(rules) > max_len:
+            rejected.append((i, '%d rules, more than %d' % (len(rules), max_len), line))
+            continue
+        if vocabulary is not None:
+            unknown = [r for r in rules if r not in vocabulary]
+            if unknown:
+                rejected.append((i, 'unknown rule: %s' % unknown[0], line))
+                continue
+
+        seq = []
+        for r in rules:
+            ix = local.setdefault(r, len(local))
+            if ix == len(counts):
+                counts.append(0)
+            counts[ix] += 1
+            seq.append(ix)
+        sequences.append(seq)
+
+    # padding is -1, which maps to 'Nothing -> None' as the last lookup entry
+    indices = np.full((len(sequences), max_len), -1, dtype=np.int16)
+    for i, seq in enumerate(sequences):
+        indices[i, :len(seq)] = seq
+
+    rule_names = [None] * len(local)
+    for r, ix in local.items():
+        rule_names[ix] = r
+    return len(lines), rule_names, np.asarray(counts, dtype=np.int64), indices, rejected
+
+# parse the corpus in parallel, count rule frequencies, build the rules
+# vocabulary (sorted, with 'Nothing -> None' last, as extract_rules does) and
+# write the index sequence datasets that generate_datasets writes
+def ingest(inputfile, outputdir, rulesfile=None, processes=None, chunk_bytes=CHUNK_BYTES, max_len=MAX_LEN):
+    fixed = None
+    if rulesfile is not None:
+        with open(rulesfile, 'r') as inputs:
+            fixed = [line.strip() for line in inputs if line.strip()]
+
+    tasks = [(inputfile, start, end, max_len) for start, end in split_file(inputfile, chunk_bytes)]
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(fixed,)) as pool:
+        chunks = list(pool.imap(ingest_chunk, tasks))
+
+    counts = {}
+    for _, rule_names, chunk_counts, _, _ in chunks:
+        for r, c in zip(rule_names, chunk_counts):
+            counts[r] = counts.get(r, 0) + int(c)
+
+    if fixed is not None:
+        rules = fixed
+    else:
+        rules = sorted(r for r in counts if r != NOTHING_RULE)
+        rules.append(NOTHING_RULE)
+    if len(rules) > np.iinfo(np.int16).max:
+        raise ValueError('%d rules do not fit the int16 datasets' % len(rules))
+    rule2index = {r: i for i, r in enumerate(rules)}
+    nothing = rule2index[NOTHING_RULE]
+
+    sequences = []
+    rejected = []
+    line_offset = 0
+    for num_lines, rule_names, _, indices, chunk_rejected in chunks:
+        lookup = np.array([rule2index[r] for r in rule_names] + [nothing], dtype=np.int16)
+        sequences.append(lookup[indices])
+        rejected.extend((line_offset + i + 1, reason, line) for i, reason, line in chunk_rejected)
+        line_offset += num_lines
+    indices = np.concatenate(sequences) if sequences else np.zeros((0, max_len), dtype=np.int16)
+
+    with open(os.path.join(outputdir, 'rules-cfg.txt'), 'w') as outf:
+        for r in rules:
+            outf.write(r + '\n')
+    with open(os.path.join(outputdir, 'rule-counts.txt'), 'w') as outf:
+        for r in rules:
+            outf.write('%d\t%s\n' % (counts.get(r, 0), r))
+    with open(os.path.join(outputdir, 'rejected.txt'), 'w') as outf:
+        for line_number, reason, line in rejected:
+            outf.write('%d\t%s\t%s\n' % (line_number, reason, line))
+
+    split = int(0.1 * indices.shape[0])
+    write_dataset(os.path.join(outputdir, 'test.h5'), indices[0:split], len(rules))
+    write_dataset(os.path.join(outputdir, 'train.h5'), indices[split:], len(rules))
+    write_dataset(os.path.join(outputdir, 'dev.h5'), indices[0:1000], len(rules))
+
+    return rules, indices, rejected
+
+def main():
+    args = get_arguments()
+    start = time.time()
+    rules, indices, rejected = ingest(args.input, args.outputdir, args.rules, args.processes, args.chunk * 2**20, args.max_len)
+    elapsed = time.time() - start
+
+    print('number of rules: %d' % len(rules))
+    print('specs kept: %d, rejected: %d (see rejected.txt)' % (indices.shape[0], len(rejected)))
+    print('%.1f s, %.0f specs/s with %d processes' % (elapsed, (indices.shape[0] + len(rejected)) / max(elapsed, 1e-9), args.processes))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+##################################################
+## Training settings shared by the scripts
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import os
+
+MAX_LEN = 20
+LATENT = 20
+EPOCHS = 100
+BATCH = 200
+DATA_FILE = 'trainingdata/train.h5'
+RULES_FILE = 'trainingdata/rules-cfg-all.txt'
+LOG_DIR = '/tmp/visgvae/'
+
+# the hyperparameters are part of the file name, which VisVAE reads them back from
+def model_filename(hidden, dense, conv1, conv2, conv3, latent, batch):
+    return 'trained/vae_H%d_D%d_C%d%d%d_%d%d%d_L%d_B%d.hdf5' % (hidden, dense, conv1[0], conv2[0], conv3[0], conv1[1], conv2[1], conv3[1], latent, batch)
+
+# TensorBoard logs of a model, apart from those of other configurations
+def log_dir(modelfile):
+    return LOG_DIR + os.path.splitext(os.path.basename(modelfile))[0]
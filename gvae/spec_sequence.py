@@ -0,0 +1,90 @@
+##################################################
+## Keras batches of compact training datasets
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import collections
+import threading
+import h5py
+import numpy as np
+
+from keras.utils import Sequence
+
+from dataset import expand
+
+BLOCK_BATCHES = 16
+CACHE_BLOCKS = 4
+
+# batches of (one-hot, one-hot) over rows [start, stop) of a compact dataset, for
+# fitting the autoencoder. Indices are read in blocks of block_batches batches,
+# and every batch lies within one block. Shuffling visits the blocks in a new
+# random order every epoch and shuffles the rows within each block, so fit with
+# shuffle=False to keep the batches of a block together. The cache_blocks most
+# recently used blocks stay in memory, so threads reading ahead across a block
+# boundary do not read the same blocks again and again. Batches may be requested
+# from several threads; the one-hot expansion runs outside the lock
+class SpecSequence(Sequence):
+    def __init__(self, filename, batch_size, start=0, stop=None, shuffle=True, block_batches=BLOCK_BATCHES, seed=None,
+            cache_blocks=CACHE_BLOCKS):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_rows = batch_size * block_batches
+        self.random = np.random.RandomState(seed)
+
+        with h5py.File(filename, 'r') as f:
+            self.num_rules = int(f.attrs['num_rules'])
+            rows = f['indices'].shape[0]
+        self.start = start
+        self.stop = rows if stop is None else min(stop, rows)
+
+        self.num_blocks = (self.stop - self.start + self.block_rows - 1) // self.block_rows
+        self.cache_blocks = cache_blocks
+        self._file = None
+        self._blocks = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.on_epoch_end()
+
+    def __len__(self):
+        return (self.stop - self.start + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, i):
+        block, offset = self.batches[i]
+        indices = self._read_block(block)[offset:offset + self.batch_size]
+        x = expand(indices, self.num_rules)
+        return x, x
+
+    def on_epoch_end(self):
+        order = np.arange(self.num_blocks)
+        self.epoch_seed = self.random.randint(2**31)
+        if self.shuffle:
+            self.random.shuffle(order)
+
+        # (block, offset) of every batch; the last block may be short
+        self.batches = []
+        for block in order:
+            rows = min(self.block_rows, self.stop - self.start - block * self.block_rows)
+            self.batches.extend((block, offset) for offset in range(0, rows, self.batch_size))
+        # the rows of a block are shuffled anew every epoch
+        with self._lock:
+            self._blocks.clear()
+
+    def _read_block(self, block):
+        with self._lock:
+            if block in self._blocks:
+                self._blocks.move_to_end(block)
+                return self._blocks[block]
+
+            if self._file is None:
+                self._file = h5py.File(self.filename, 'r')
+            begin = self.start + block * self.block_rows
+            rows = self._file['indices'][begin:min(begin + self.block_rows, self.stop)]
+            if self.shuffle:
+                rows = rows[np.random.RandomState(self.epoch_seed + block).permutation(rows.shape[0])]
+
+            self._blocks[block] = rows
+            if len(self._blocks) > self.cache_blocks:
+                self._blocks.popitem(last=False)
+            return rows
@@ -0,0 +1,197 @@
+##################################################
+## Hyperparameter sweeps
+##################################################
+## Author: Jian Zhao
+## Contact: jeffjianzhao@gmail.com
+##################################################
+
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from settings import MAX_LEN, RULES_FILE, EPOCHS, BATCH, model_filename
+
+SWEEP_DIR = 'trained/sweep/'
+TEST_FILE = 'trainingdata/test.h5'
+LATENCY_REPEAT = 50
+EVAL_THREADS = 1
+DEFAULTS = {'hidden': 256, 'dense': 256, 'conv1': [8, 3], 'conv2': [8, 3], 'conv3': [8, 3], 'latent': 20, 'batch': BATCH, 'epochs': EPOCHS}
+COLUMNS = ['name', 'hidden', 'dense', 'conv1', 'conv2', 'conv3', 'latent', 'batch', 'epochs', 'trained_epochs',
+    'val_loss', 'accuracy', 'encode_ms', 'decode_ms', 'samples_per_sec', 'model']
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='Train and compare grammar VAE configurations')
+
+    parser.add_argument('sweep', nargs='?', help='JSON file with {"grid": {param: [values]}} or {"configs": [{param: value}]}, '
+        'and optional "defaults"; params are those of train.py plus epochs')
+    parser.add_argument('--jobs', type=int, metavar='N', default=1, help='configurations trained at once')
+    parser.add_argument('--threads', type=int, metavar='N', default=0,
+        help='TensorFlow threads per job, by default the cores divided by --jobs')
+    parser.add_argument('--eval-threads', type=int, metavar='N', default=EVAL_THREADS,
+        help='TensorFlow threads of the evaluations, which run one at a time after training')
+    parser.add_argument('--output', metavar='FILE', default=SWEEP_DIR + 'results.csv')
+    parser.add_argument('--evaluate', metavar='MODEL', help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+def load_configs(sweepfile):
+    with open(sweepfile, 'r') as inputs:
+        sweep = json.load(inputs)
+
+    defaults = dict(DEFAULTS, **sweep.get('defaults', {}))
+    configs = [dict(defaults, **c) for c in sweep.get('configs', [])]
+    grid = sweep.get('grid', {})
+    if grid:
+        keys = sorted(grid.keys())
+        for values in itertools.product(*[grid[k] for k in keys]):
+            configs.append(dict(defaults, **dict(zip(keys, values))))
+
+    # configurations that share a model file would train the same checkpoint
+    unique = {}
+    for config in configs:
+        unique.setdefault(config_name(config), config)
+    return list(unique.values())
+
+def config_name(config):
+    return os.path.splitext(os.path.basename(config_model(config)))[0]
+
+def config_model(config):
+    return model_filename(config['hidden'], config['dense'], config['conv1'], config['conv2'], config['conv3'], config['latent'], config['batch'])
+
+# one line per epoch that train.py finished for this configuration
+def read_perf_log(perflog):
+    if not os.path.isfile(perflog):
+        return []
+    with open(perflog, 'r') as inputs:
+        return [json.loads(line) for line in inputs if line.strip()]
+
+def run_logged(command, logfile, threads):
+    # native thread pools outside TensorFlow (e.g. numpy's BLAS) follow the same limit
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads), MKL_NUM_THREADS=str(threads), OPENBLAS_NUM_THREADS=str(threads))
+    with open(logfile, 'a') as log:
+        return subprocess.call(command, stdout=log, stderr=subprocess.STDOUT, env=env)
+
+# train a configuration for the epochs it has left and return its row of the
+# results table; train.py continues from an existing checkpoint
+def run_config(config, threads):
+    name = config_name(config)
+    perflog = SWEEP_DIR + name + '.jsonl'
+    logfile = SWEEP_DIR + name + '.log'
+
+    remaining = config['epochs'] - len(read_perf_log(perflog))
+    if remaining > 0:
+        print('%s: training %d epochs' % (name, remaining))
+        command = [sys.executable, 'train.py', '--epochs', str(remaining), '--latent', str(config['latent']), '--batch', str(config['batch']),
+            '--hidden', str(config['hidden']), '--dense', str(config['dense']),
+            '--conv1'] + [str(v) for v in config['conv1']] + ['--conv2'] + [str(v) for v in config['conv2']] + \
+            ['--conv3'] + [str(v) for v in config['conv3']] + \
+            ['--intra-threads', str(threads), '--inter-threads', '1', '--workers', '1', '--perf-log', perflog]
+        if run_logged(command, logfile, threads) != 0:
+            print('%s: training failed, see %s' % (name, logfile))
+    else:
+        print('%s: already trained' % name)
+
+    row = dict(config, name=name, model=config_model(config))
+    epochs = read_perf_log(perflog)
+    row['trained_epochs'] = len(epochs)
+    val_losses = [e['val_loss'] for e in epochs if 'val_loss' in e]
+    row['val_loss'] = min(val_losses) if val_losses else None
+    row['samples_per_sec'] = float(np.median([e['samples_per_sec'] for e in epochs])) if epochs else None
+    return row
+
+# add the accuracy and latencies of a trained configuration to its row; the
+# evaluation loads TensorFlow, so it runs in its own process
+def evaluate_row(row, threads):
+    if not os.path.isfile(row['model']):
+        return
+    logfile = SWEEP_DIR + row['name'] + '.log'
+    evalfile = SWEEP_DIR + row['name'] + '.eval.json'
+    command = [sys.executable, 'sweep.py', '--evaluate', row['model'], '--threads', str(threads), '--output', evalfile]
+    if run_logged(command, logfile, threads) == 0:
+        with open(evalfile, 'r') as inputs:
+            row.update(json.load(inputs))
+
+# reconstruction accuracy on the test set as in data_utils.test_vaemodel, and
+# the median single-chart latency of the encoder and the decoder
+def evaluate(modelfile, threads, outputfile):
+    import re
+    import tensorflow as tf
+    from keras import backend as K
+    from vis_vae import VisVAE
+    from dataset import read_onehot
+
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=1)))
+    with open(RULES_FILE, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+    latent = int(re.search(r'_L(\d+)_', modelfile).group(1))
+    visvae = VisVAE(modelfile, rules, MAX_LEN, latent)
+
+    data = read_onehot(TEST_FILE)
+    output = visvae.vae.autoencoder.predict(data)
+    accuracy = np.mean(np.equal(np.argmax(data, axis=2), np.argmax(output, axis=2)))
+
+    def latency(fn, x):
+        fn(x)
+        times = []
+        for _ in range(LATENCY_REPEAT):
+            start = time.time()
+            fn(x)
+            times.append(time.time() - start)
+        return float(np.median(times)) * 1000
+
+    z = visvae.vae.encoderMV.predict(data[:1])[0]
+    result = {
+        'accuracy': float(accuracy),
+        'encode_ms': latency(visvae.vae.encoderMV.predict, data[:1]),
+        'decode_ms': latency(visvae.vae.decoder.predict, z),
+    }
+    with open(outputfile, 'w') as outputs:
+        json.dump(result, outputs)
+
+def write_results(rows, outputfile):
+    with open(outputfile, 'w') as outputs:
+        writer = csv.DictWriter(outputs, COLUMNS, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
+
+    def fmt(v, spec):
+        return spec % v if v is not None else '-'
+    print('%-40s %6s %10s %9s %10s %10s' % ('model', 'epochs', 'val_loss', 'accuracy', 'encode ms', 'decode ms'))
+    for row in sorted(rows, key=lambda r: (r.get('val_loss') is None, r.get('val_loss'))):
+        print('%-40s %6d %10s %9s %10s %10s' % (row['name'], row['trained_epochs'], fmt(row.get('val_loss'), '%.4f'),
+            fmt(row.get('accuracy'), '%.4f'), fmt(row.get('encode_ms'), '%.2f'), fmt(row.get('decode_ms'), '%.2f')))
+
+def main():
+    args = get_arguments()
+    threads = args.threads or max(1, multiprocessing.cpu_count() // args.jobs)
+
+    if args.evaluate:
+        evaluate(args.evaluate, args.threads or EVAL_THREADS, args.output)
+        return
+
+    if not os.path.isdir(SWEEP_DIR):
+        os.makedirs(SWEEP_DIR)
+    configs = load_configs(args.sweep)
+    print('%d configurations, %d at a time with %d threads each' % (len(configs), args.jobs, threads))
+
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        rows = list(pool.map(lambda c: run_config(c, threads), configs))
+
+    # latencies are only comparable when no training competes for the cores
+    # and every model gets the same threads
+    for row in rows:
+        evaluate_row(row, args.eval_threads)
+    write_results(rows, args.output)
+
+if __name__ == '__main__':
+    main()
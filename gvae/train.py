@@ -9,17 +9,23 @@
 from __future__ import print_function
 
 import argparse
+import json
 import os
+import resource
+import time
 import h5py
 import numpy as np
+import tensorflow as tf
 
 from model_vae import ModelVAE
-from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, TensorBoard
+from dataset import is_compact
+from spec_sequence import SpecSequence
+from settings import MAX_LEN, LATENT, EPOCHS, BATCH, DATA_FILE, RULES_FILE, model_filename, log_dir
+from keras import backend as K
+from keras.callbacks import Callback, ModelCheckpoint, ReduceLROnPlateau, TensorBoard
 
-MAX_LEN = 20
-LATENT = 20
-EPOCHS = 100
-BATCH = 200
+WORKERS = 2
+PREFETCH = 10
 
 def get_arguments():
     params = {'hidden': 256, 'dense': 256, 'conv1': [8, 3], 'conv2': [8, 3], 'conv3': [8, 3]}
@@ -35,25 +41,91 @@ def get_arguments():
     parser.add_argument('--conv1', type=int, metavar='N', nargs=2, default=params['conv1'])
     parser.add_argument('--conv2', type=int, metavar='N', nargs=2, default=params['conv2'])
     parser.add_argument('--conv3', type=int, metavar='N', nargs=2, default=params['conv3'])
+
+    parser.add_argument('--intra-threads', type=int, metavar='N', default=0,
+        help='TensorFlow threads within an op, 0 for one per core')
+    parser.add_argument('--inter-threads', type=int, metavar='N', default=0,
+        help='TensorFlow ops run at once, 0 for one per core')
+    parser.add_argument('--workers', type=int, metavar='N', default=WORKERS,
+        help='threads that prepare batches of compact datasets')
+    parser.add_argument('--prefetch', type=int, metavar='N', default=PREFETCH,
+        help='batches prepared ahead of training')
+    parser.add_argument('--perf-log', metavar='FILE', default=None,
+        help='append the performance of every epoch to this file as JSON lines')
     
     return parser.parse_args()
 
+# logs samples per second, step time percentiles and peak RSS after every epoch;
+# the numbers also go into the epoch logs, so TensorBoard records them
+class PerformanceLogger(Callback):
+    def __init__(self, batch_size, logfile=None):
+        super(PerformanceLogger, self).__init__()
+        self.batch_size = batch_size
+        self.logfile = logfile
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.time()
+        self.step_times = []
+        self.samples = 0
+        self.train_end = self.epoch_start
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step_start = time.time()
+
+    def on_batch_end(self, batch, logs=None):
+        self.train_end = time.time()
+        self.step_times.append(self.train_end - self.step_start)
+        self.samples += (logs or {}).get('size', self.batch_size)
+
+    # throughput is over the training steps, without validation
+    def on_epoch_end(self, epoch, logs=None):
+        elapsed = time.time() - self.epoch_start
+        steps = np.array(self.step_times) * 1000
+        perf = {
+            'samples_per_sec': self.samples / max(self.train_end - self.epoch_start, 1e-9),
+            'step_ms_p50': float(np.percentile(steps, 50)) if len(steps) else 0.0,
+            'step_ms_p90': float(np.percentile(steps, 90)) if len(steps) else 0.0,
+            'step_ms_p99': float(np.percentile(steps, 99)) if len(steps) else 0.0,
+            # kilobytes on Linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        }
+        print('epoch %d: %.0f samples/s, step p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, peak RSS %.0f MB' % (epoch + 1,
+            perf['samples_per_sec'], perf['step_ms_p50'], perf['step_ms_p90'], perf['step_ms_p99'], perf['peak_rss_mb']))
+
+        if logs is not None:
+            logs.update(perf)
+        if self.logfile:
+            # with the losses and metrics of the epoch
+            record = {k: float(v) for k, v in (logs or perf).items()}
+            record.update(epoch=epoch + 1, seconds=elapsed)
+            with open(self.logfile, 'a') as outf:
+                outf.write(json.dumps(record) + '\n')
+
 def main():
-    # 0. load dataset and rules
-    h5f = h5py.File('trainingdata/train.h5', 'r')
-    data = h5f['data'][:]
-    h5f.close()
+    # 0. load dataset and rules; compact datasets are streamed a batch at a time
+    datafile = DATA_FILE
+    compact = is_compact(datafile)
+    if compact:
+        with h5py.File(datafile, 'r') as h5f:
+            rows = h5f['indices'].shape[0]
+    else:
+        h5f = h5py.File(datafile, 'r')
+        data = h5f['data'][:]
+        h5f.close()
 
     rules = []
-    with open('trainingdata/rules-cfg-all.txt', 'r') as inputs:
+    with open(RULES_FILE, 'r') as inputs:
         for line in inputs:
             line = line.strip()
             rules.append(line)
 
     # 1. get any arguments and define save file, then create the VAE model
     args = get_arguments()
+    config = tf.ConfigProto(intra_op_parallelism_threads = args.intra_threads, inter_op_parallelism_threads = args.inter_threads)
+    K.set_session(tf.Session(config = config))
+
     params = {'hidden': args.hidden, 'dense': args.dense, 'conv1': args.conv1, 'conv2': args.conv2, 'conv3': args.conv3}
-    model_save = 'trained/vae_H%d_D%d_C%d%d%d_%d%d%d_L%d_B%d.hdf5' % (args.hidden, args.dense, args.conv1[0], args.conv2[0], args.conv3[0], args.conv1[1], args.conv2[1], args.conv3[1], args.latent, args.batch)
+    model_save = model_filename(args.hidden, args.dense, args.conv1, args.conv2, args.conv3, args.latent, args.batch)
     model = ModelVAE()
     
     # 2. if this results file exists already load it
@@ -68,15 +140,33 @@ def main():
     reduce_lr = ReduceLROnPlateau(monitor = 'val_loss', factor = 0.2, patience = 1, min_lr = 0.00001)
 
     # 4. fit the vae
-    model.autoencoder.fit(
-        data,
-        data,
-        shuffle = True,
-        epochs = args.epochs,
-        batch_size = BATCH,
-        callbacks = [checkpointer, reduce_lr, TensorBoard(log_dir='/tmp/visgvae')],
-        validation_split = 0.1
-    )
+    # the performance logger goes first, so the other callbacks see its numbers
+    callbacks = [PerformanceLogger(args.batch, args.perf_log), checkpointer, reduce_lr, TensorBoard(log_dir=log_dir(model_save))]
+    if compact:
+        # the last 10% of the rows validate, as with validation_split; worker
+        # threads expand batches while the model trains on earlier ones
+        split = int(rows * (1 - 0.1))
+        model.autoencoder.fit_generator(
+            SpecSequence(datafile, args.batch, stop = split),
+            epochs = args.epochs,
+            callbacks = callbacks,
+            validation_data = SpecSequence(datafile, args.batch, start = split, shuffle = False),
+            workers = args.workers,
+            max_queue_size = args.prefetch,
+            use_multiprocessing = False,
+            # SpecSequence shuffles by block, Keras' shuffling would read them at random
+            shuffle = False
+        )
+    else:
+        model.autoencoder.fit(
+            data,
+            data,
+            shuffle = True,
+            epochs = args.epochs,
+            batch_size = args.batch,
+            callbacks = callbacks,
+            validation_split = 0.1
+        )
 
 if __name__ == '__main__':
     main()
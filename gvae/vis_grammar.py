@@ -36,6 +36,13 @@ class VisGrammar():
                     self.rhs_map[count].extend(list(np.where(np.array(self.lhs_list) == s)[0]))
             count = count + 1
 
+        # padded array form of rhs_map, with the rhs symbols stored in reverse so
+        # that pushing a row onto a stack leaves the leftmost symbol on top
+        self.rhs_count = np.array([len(a) for a in self.rhs_map], dtype=np.int32)
+        self.rhs_index = np.zeros((D, max(1, self.rhs_count.max())), dtype=np.int32)
+        for i, a in enumerate(self.rhs_map):
+            self.rhs_index[i, :len(a)] = a[::-1]
+
         # this tells us for each lhs symbol which productions rules should be masked
         self.masks = np.zeros((len(self.lhs_list), D))
         count = 0
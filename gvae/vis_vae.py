@@ -11,7 +11,6 @@ import re
 import numpy as np
 import nltk
 
-from model_vae import ModelVAE
 from vis_grammar import VisGrammar
 
 def get_rules(node, parentkey, rules):
@@ -25,38 +24,50 @@ def get_rules(node, parentkey, rules):
         else:
             rules.append(k + ' -> ' + '"' + str(v) + '"')
 
-def get_specs(rules):
-    spectree = {'name':'root', 'parent':None}
-    Q = [spectree]
-
-    for r in rules:  
-        for node in filter(lambda x: x['name'] == str(r.lhs()), Q):
-            for symbol in r.rhs():
-                symbol_name = str(symbol)
-                if type(symbol) == nltk.grammar.Nonterminal:
-                    node[symbol_name] = {'name':symbol_name, 'parent':node}
-                    Q.append(node[symbol_name])
-                elif symbol_name != '+':
-                    if symbol_name == 'True':
-                        node['parent'][node['name']] = True
-                    elif symbol_name == 'False':
-                        node['parent'][node['name']] = False
-                    else:
-                        try:
-                            node['parent'][node['name']] = float(symbol_name)
-                        except:
-                            node['parent'][node['name']] = symbol_name
-    
-    clean_tree(Q[0])
-    return json.dumps(Q[0])    
-
-def clean_tree(node):
-    del node['parent']
-    del node['name']
-
-    for k, v in node.items():
-        if type(v) is dict:
-            clean_tree(v)
+# builds specs from production index sequences by expanding the leftmost open
+# nonterminal, i.e. replaying the derivation that get_rules records
+class SpecBuilder():
+    def __init__(self, productions):
+        self.terminal = []
+        self.values = []
+        self.children = []
+
+        for prod in productions:
+            children = [str(a) for a in prod.rhs() if type(a) == nltk.grammar.Nonterminal and str(a) != 'None']
+            terminals = [str(a) for a in prod.rhs() if type(a) != nltk.grammar.Nonterminal and str(a) != '+']
+            self.children.append(children)
+            self.terminal.append(len(terminals) > 0)
+            self.values.append(self._parse_value(terminals[0]) if terminals else None)
+
+    def build(self, indices, as_json=True):
+        specs = []
+        for row in np.asarray(indices).tolist():
+            holder = {'root': {}}
+            stack = [(holder, 'root')]
+            for ix in row:
+                if not stack:
+                    break
+                parent, key = stack.pop()
+                if self.terminal[ix]:
+                    parent[key] = self.values[ix]
+                else:
+                    node = parent[key]
+                    for name in self.children[ix]:
+                        node[name] = {}
+                    stack.extend((node, name) for name in reversed(self.children[ix]))
+
+            specs.append(json.dumps(holder['root']) if as_json else holder['root'])
+        return specs
+
+    def _parse_value(self, symbol_name):
+        if symbol_name == 'True':
+            return True
+        elif symbol_name == 'False':
+            return False
+        try:
+            return float(symbol_name)
+        except ValueError:
+            return symbol_name
 
 class VisVAE():
     def __init__(self, weights_file, rules, max_len, latent_dim):
@@ -71,13 +82,25 @@ class VisVAE():
 
         self.grammar = VisGrammar(rules)
         self.productions = self.grammar.GCFG.productions()
+        self.spec_builder = SpecBuilder(self.productions)
         self.lhs_map = {}
         for ix, lhs in enumerate(self.grammar.lhs_list):
             self.lhs_map[lhs] = ix
 
-        hypers = self._get_hypers(weights_file)
-        self.vae = ModelVAE()
-        self.vae.load(self.rules, weights_file, max_length=self.max_len, latent_rep_size=self.latent_dim, hypers=hypers)
+        # tables for the vectorized sampler: an empty stack yields 'Nothing', whose
+        # only production pads the rest of the sequence
+        self.start_lhs = self.lhs_map[self.grammar.start_index]
+        self.nothing_lhs = self.lhs_map['Nothing']
+        self.nothing_index = int(np.argmax(self.grammar.masks[self.nothing_lhs]))
+        self.stack_depth = 1 + self.max_len * self.grammar.rhs_index.shape[1]
+
+        # a model without weights only supports grammar operations
+        self.vae = None
+        if weights_file is not None:
+            from model_vae import ModelVAE
+            hypers = self._get_hypers(weights_file)
+            self.vae = ModelVAE()
+            self.vae.load(self.rules, weights_file, max_length=self.max_len, latent_rep_size=self.latent_dim, hypers=hypers)
 
     def encode(self, sentences):
         one_hot = np.zeros((len(sentences), self.max_len, self.input_dim), dtype=np.float32)
@@ -94,47 +117,57 @@ class VisVAE():
         self.one_hot = one_hot
         return self.vae.encoderMV.predict(one_hot)[0]
 
-    def decode(self, z):
+    def decode(self, z, as_json=True):
         assert z.ndim == 2
         unmasked = self.vae.decoder.predict(z)
-        X_hat = self._sample_using_masks(unmasked)
-
-        # Convert from one-hot to sequence of production rules
-        prod_seq = [[self.productions[X_hat[index, t].argmax()] for t in range(X_hat.shape[1])] 
-            for index in range(X_hat.shape[0])]
-        return [get_specs(prods) for prods in prod_seq]
+        indices = self._sample_indices(unmasked)
+        return self.spec_builder.build(indices, as_json)
 
     def _sample_using_masks(self, unmasked):
-        eps = 1e-100
+        indices = self._sample_indices(unmasked)
         X_hat = np.zeros_like(unmasked)
+        X_hat[np.arange(indices.shape[0])[:, None], np.arange(indices.shape[1]), indices] = 1.0
+        return X_hat
+
+    def _sample_indices(self, unmasked):
+        eps = 1e-100
+        batch, steps = unmasked.shape[0], unmasked.shape[1]
+        rows = np.arange(batch)
+        indices = np.full((batch, steps), self.nothing_index, dtype=np.int32)
 
-        # Create a stack for each input in the batch
-        S = np.empty((unmasked.shape[0],), dtype=object)
-        for ix in range(S.shape[0]):
-            S[ix] = [str(self.grammar.start_index)]
+        # Keep the stacks of all inputs in one array, with a stack pointer per row
+        S = np.zeros((batch, self.stack_depth), dtype=np.int32)
+        S[:, 0] = self.start_lhs
+        top = np.ones(batch, dtype=np.int32)
+        offsets = np.arange(self.grammar.rhs_index.shape[1])
 
         # Loop over time axis, sampling values and updating masks
-        for t in range(unmasked.shape[1]):
-            next_nonterminal = [self.lhs_map[self._pop_or_nothing(a)] for a in S]
+        for t in range(steps):
+            nonempty = top > 0
+            # once every stack is empty only 'Nothing' can follow, so the padding
+            # already in place is the result
+            if not nonempty.any():
+                break
+            top -= nonempty
+            next_nonterminal = np.where(nonempty, S[rows, top], self.nothing_lhs)
             mask = self.grammar.masks[next_nonterminal]
-            masked_output = np.exp(unmasked[:, t ,:]) * mask + eps
-            sampled_output = np.argmax(np.random.gumbel(size=masked_output.shape) + np.log(masked_output), axis=-1)
-            X_hat[np.arange(unmasked.shape[0]), t, sampled_output] = 1.0
-
-            # Identify non-terminals in RHS of selected production, and
-            # push them onto the stack in reverse order
-            rhs = [filter(lambda a: (type(a) == nltk.grammar.Nonterminal) and (str(a) != 'None'), self.productions[i].rhs()) 
-                for i in sampled_output]
-            for ix in range(S.shape[0]):
-                S[ix].extend(list(map(str, rhs[ix]))[::-1])
-
-        return X_hat
-
-    def _pop_or_nothing(self, S):
-        try: 
-            return S.pop()
-        except: 
-            return 'Nothing' 
+            masked_output = np.exp(unmasked[:, t, :]) * mask + eps
+            # inverse-CDF draw from masked_output, the same distribution as taking the
+            # argmax over Gumbel-perturbed logits but with one uniform per row
+            cdf = np.cumsum(masked_output, axis=-1)
+            u = np.random.random_sample(batch) * cdf[:, -1]
+            sampled_output = np.minimum((cdf <= u[:, None]).sum(axis=-1), cdf.shape[1] - 1)
+            indices[:, t] = sampled_output
+
+            # Push the non-terminals in RHS of selected production onto the stack,
+            # in reverse order
+            count = self.grammar.rhs_count[sampled_output]
+            pushed = offsets < count[:, None]
+            pos = top[:, None] + offsets
+            S[np.nonzero(pushed)[0], pos[pushed]] = self.grammar.rhs_index[sampled_output][pushed]
+            top += count
+
+        return indices
 
     def _get_hypers(self, filename):
         hypers = {}
@@ -0,0 +1,89 @@
+import collections
+import threading
+import time
+import numpy as np
+
+from metrics import Histogram
+
+DEPTH_BUCKETS = [1, 2, 4, 8, 16, 32, 64]
+SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024]
+
+class _Request():
+    def __init__(self, x):
+        self.x = x
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+# gathers the inputs of concurrent callers for up to window seconds, or until
+# max_batch rows are waiting, runs fn once on all of them and hands every caller
+# its own rows of the result
+class MicroBatcher():
+    def __init__(self, fn, window=0.005, max_batch=256):
+        self.fn = fn
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.queue_depth = Histogram(DEPTH_BUCKETS)
+        self.batch_size = Histogram(SIZE_BUCKETS)
+
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, x):
+        if len(x) == 0:
+            return self.fn(x)
+
+        request = _Request(x)
+        with self._cond:
+            self._pending.append(request)
+            self._cond.notify()
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def stats(self):
+        return {'batches': self.batches, 'queue_depth': self.queue_depth.snapshot(),
+            'batch_size': self.batch_size.snapshot()}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while len(self._pending) == 0:
+                    self._cond.wait()
+
+                deadline = time.monotonic() + self.window
+                while sum(len(r.x) for r in self._pending) < self.max_batch:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+                self.queue_depth.observe(len(self._pending))
+                # a single oversized request still runs, on its own
+                batch = [self._pending.popleft()]
+                rows = len(batch[0].x)
+                while len(self._pending) > 0 and rows + len(self._pending[0].x) <= self.max_batch:
+                    batch.append(self._pending.popleft())
+                    rows += len(batch[-1].x)
+
+            self._execute(batch, rows)
+
+    def _execute(self, batch, rows):
+        self.batches += 1
+        self.batch_size.observe(rows)
+        try:
+            result = self.fn(np.concatenate([r.x for r in batch]))
+            start = 0
+            for r in batch:
+                r.result = result[start:start + len(r.x)]
+                start += len(r.x)
+        except Exception as e:
+            for r in batch:
+                r.error = e
+        for r in batch:
+            r.done.set()
@@ -0,0 +1,89 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import nltk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gvaemodel.vis_vae import VisVAE
+
+rulesfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'gvaemodel', 'rules-cfg.txt')
+MAX_LEN = 20
+LATENT = 20
+
+# the list-stack sampler that VisVAE._sample_using_masks used before vectorization
+def legacy_sample(visvae, unmasked):
+    eps = 1e-100
+    X_hat = np.zeros_like(unmasked)
+
+    S = np.empty((unmasked.shape[0],), dtype=object)
+    for ix in range(S.shape[0]):
+        S[ix] = [str(visvae.grammar.start_index)]
+    productions = visvae.grammar.GCFG.productions()
+
+    def pop_or_nothing(stack):
+        try:
+            return stack.pop()
+        except:
+            return 'Nothing'
+
+    for t in range(unmasked.shape[1]):
+        next_nonterminal = [visvae.lhs_map[pop_or_nothing(a)] for a in S]
+        mask = visvae.grammar.masks[next_nonterminal]
+        masked_output = np.exp(unmasked[:, t, :]) * mask + eps
+        sampled_output = np.argmax(np.random.gumbel(size=masked_output.shape) + np.log(masked_output), axis=-1)
+        X_hat[np.arange(unmasked.shape[0]), t, sampled_output] = 1.0
+
+        rhs = [filter(lambda a: (type(a) == nltk.grammar.Nonterminal) and (str(a) != 'None'), productions[i].rhs())
+            for i in sampled_output]
+        for ix in range(S.shape[0]):
+            S[ix].extend(list(map(str, rhs[ix]))[::-1])
+
+    return X_hat
+
+def load_visvae():
+    with open(rulesfile, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+    return VisVAE(None, rules, MAX_LEN, LATENT)
+
+def time_call(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+# compare per-timestep production frequencies of the two samplers on the same logits
+def check_distribution(visvae, samples, rng):
+    logits = rng.uniform(-3, 3, size=(1, MAX_LEN, len(visvae.rules))).astype(np.float32)
+    unmasked = np.repeat(logits, samples, axis=0)
+    old = legacy_sample(visvae, unmasked).mean(axis=0)
+    new = visvae._sample_using_masks(unmasked).mean(axis=0)
+    return np.abs(old - new).max()
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the grammar-masked sampler')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 50, 500, 5000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--check', type=int, metavar='N', default=20000,
+        help='number of samples for the distribution check, 0 to skip')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(13)
+    visvae = load_visvae()
+
+    print('%8s %12s %12s %9s' % ('batch', 'legacy (ms)', 'vector (ms)', 'speedup'))
+    for batch in args.batch:
+        unmasked = rng.uniform(-3, 3, size=(batch, MAX_LEN, len(visvae.rules))).astype(np.float32)
+        old = time_call(lambda: legacy_sample(visvae, unmasked), args.repeat)
+        new = time_call(lambda: visvae._sample_using_masks(unmasked), args.repeat)
+        print('%8d %12.2f %12.2f %8.1fx' % (batch, old * 1000, new * 1000, old / new))
+
+    if args.check > 0:
+        print('max frequency difference over %d samples: %.4f' % (args.check, check_distribution(visvae, args.check, rng)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gvaemodel.vis_vae import VisVAE, get_rules, ENGINES
+
+here = os.path.dirname(os.path.abspath(__file__))
+rulesfile = os.path.join(here, '..', 'gvaemodel', 'rules-cfg.txt')
+modelsave = os.path.join(here, '..', 'gvaemodel', 'vae_H256_D256_C444_333_L20_B200.hdf5')
+specfile = os.path.join(here, '..', '..', 'sourcedata', 'vegaspecs-processed.txt')
+MAX_LEN = 20
+LATENT = 20
+TARGETS = 10
+
+# Glorot-uniform weights for the layers ModelVAE builds, by layer name as
+# weights.read_weights returns them; stands in for a trained model, whose values
+# do not change the cost of a forward pass
+def random_weights(num_rules, hypers, rng):
+    def glorot(*shape):
+        limit = np.sqrt(6.0 / (np.prod(shape[:-1]) + shape[-1]))
+        return rng.uniform(-limit, limit, size=shape).astype(np.float32)
+
+    def batchnorm(n):
+        return [np.ones(n, np.float32), np.zeros(n, np.float32), np.zeros(n, np.float32), np.ones(n, np.float32)]
+
+    weights = {}
+    channels, steps = num_rules, MAX_LEN
+    for i, conv in enumerate(['conv1', 'conv2', 'conv3']):
+        filters, kernel = hypers[conv]
+        weights['conv_%d' % (i + 1)] = [glorot(kernel, channels, filters), np.zeros(filters, np.float32)]
+        weights['batch_%d' % (i + 1)] = batchnorm(filters)
+        channels, steps = filters, steps - kernel + 1
+
+    hidden, dense = hypers['hidden'], hypers['dense']
+    weights['dense_1'] = [glorot(steps * channels, dense), np.zeros(dense, np.float32)]
+    weights['z_mean'] = [glorot(dense, LATENT), np.zeros(LATENT, np.float32)]
+    weights['z_log_var'] = [glorot(dense, LATENT), np.zeros(LATENT, np.float32)]
+    weights['batch_4'] = batchnorm(LATENT)
+    weights['latent_input'] = [glorot(LATENT, LATENT), np.zeros(LATENT, np.float32)]
+    for name, inputs in [('gru_1', LATENT), ('gru_2', hidden), ('gru_3', hidden)]:
+        weights[name] = [glorot(inputs, 3 * hidden), glorot(hidden, 3 * hidden), np.zeros(3 * hidden, np.float32)]
+    weights['decoded_mean'] = [glorot(hidden, num_rules), np.zeros(num_rules, np.float32)]
+    return weights
+
+def load_visvae(engine, weights_file, rng):
+    with open(rulesfile, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+
+    # the model file name carries the hyperparameters either way
+    weights = None
+    if weights_file is None:
+        weights = random_weights(len(rules), VisVAE(None, rules, MAX_LEN, LATENT)._get_hypers(modelsave), rng)
+    return VisVAE(weights_file or modelsave, rules, MAX_LEN, LATENT, weights=weights, inference=True, engine=engine)
+
+# corpus specs that the grammar can encode, in random order
+def load_specs(visvae, rng):
+    specs = []
+    with open(specfile, 'r') as inputs:
+        for line in inputs:
+            try:
+                spec = json.loads(line)
+            except ValueError:
+                continue
+            rules = []
+            get_rules(spec, 'root', rules)
+            if len(rules) <= MAX_LEN and all(r in visvae.rule2index for r in rules):
+                specs.append(line.strip())
+    rng.shuffle(specs)
+    return specs
+
+def time_call(fn, repeat):
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {'best_ms': min(times) * 1000, 'median_ms': float(np.median(times)) * 1000}
+
+def post(client, path, data):
+    res = client.post(path, data=json.dumps(data), content_type='application/json')
+    if res.status_code != 200:
+        raise RuntimeError('%s returned %d: %s' % (path, res.status_code, res.data[:200]))
+    return res
+
+# model paths at every batch size: rule extraction, encoding (rule extraction,
+# one-hot and encoder), the decoder network, the grammar-masked sampler and spec
+# building from sampled production indices
+def model_benchmarks(visvae, specs, batches, repeat, rng):
+    for batch in batches:
+        chosen = [specs[i % len(specs)] for i in range(batch)]
+        objs = [json.loads(s) for s in chosen]
+        z = rng.normal(size=(batch, LATENT)).astype(np.float32)
+        unmasked = visvae.decoder_predict(z)
+        indices = visvae._sample_indices(unmasked)
+
+        yield 'get_rules', batch, time_call(lambda: [get_rules(obj, 'root', []) for obj in objs], repeat)
+        yield 'encode', batch, time_call(lambda: visvae.encode(chosen), repeat)
+        yield 'decoder.predict', batch, time_call(lambda: visvae.decoder_predict(z), repeat)
+        yield '_sample_using_masks', batch, time_call(lambda: visvae._sample_using_masks(unmasked), repeat)
+        yield 'get_specs', batch, time_call(lambda: visvae.spec_builder.build(indices, as_json=False), repeat)
+
+# projection endpoints at every chart set size, through the Flask app with the
+# inputs the front end sends: distances between chart embeddings for /mds, chart
+# embeddings and target distances for /invmds, two layouts for /orientate
+def layout_benchmarks(visvae, specs, sizes, repeat, rng):
+    import modelserver
+    client = modelserver.app.test_client()
+
+    for size in sizes:
+        z = visvae.encode([specs[i % len(specs)] for i in range(size)]).astype(np.float64)
+        distm = np.sqrt(np.square(z[:, None, :] - z[None, :, :]).sum(axis=-1))
+        targets = z[rng.choice(size, TARGETS)] + rng.normal(scale=0.1, size=(TARGETS, LATENT))
+        dsall = np.sqrt(np.square(targets[:, None, :] - z[None, :, :]).sum(axis=-1))
+
+        coords = np.array(json.loads(post(client, '/mds', distm.tolist()).data))
+        angle = rng.uniform(0, 2 * np.pi)
+        rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+        moved = coords.dot(rotation) * 2 + rng.normal(scale=0.01, size=coords.shape)
+
+        yield '/mds', size, time_call(lambda: post(client, '/mds', distm.tolist()), repeat)
+        yield '/invmds', size, time_call(lambda: post(client, '/invmds', {'points': z.tolist(), 'distances': dsall.tolist()}), repeat)
+        yield '/orientate', size, time_call(lambda: post(client, '/orientate', [coords.tolist(), moved.tolist()]), repeat)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# ratio of the median times to those of an earlier run, for the entries both have
+def compare(results, previous):
+    before = {(r['name'], r['size']): r for r in previous['results']}
+    print('\ncompared with %s' % (previous['meta'].get('commit') or 'previous run'))
+    print('%-22s %8s %12s %12s %8s' % ('benchmark', 'size', 'before ms', 'after ms', 'ratio'))
+    for r in results:
+        b = before.get((r['name'], r['size']))
+        if b is not None:
+            print('%-22s %8d %12.3f %12.3f %7.2fx' % (r['name'], r['size'], b['median_ms'], r['median_ms'], r['median_ms'] / b['median_ms']))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the modelserver hot paths on CPU')
+    parser.add_argument('--engine', choices=ENGINES, default='keras')
+    parser.add_argument('--weights', metavar='FILE', default=None,
+        help='trained model; by default the one in gvaemodel/ if present, else random weights')
+    parser.add_argument('--random', action='store_true', help='use random weights even if a trained model is present')
+    parser.add_argument('--batch', type=int, nargs='+', default=[1, 10, 100, 1000], help='specs or latent vectors per call')
+    parser.add_argument('--charts', type=int, nargs='+', default=[10, 50, 200], help='chart set sizes for the projections')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=13)
+    parser.add_argument('--output', metavar='FILE', default=None, help='JSON results, by default bench-<commit>.json in the temporary directory')
+    parser.add_argument('--compare', metavar='FILE', default=None, help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    np.random.seed(args.seed)
+    rng = np.random.RandomState(args.seed)
+    random.seed(args.seed)
+    weights_file = args.weights
+    if weights_file is None and not args.random and os.path.isfile(modelsave):
+        weights_file = modelsave
+
+    visvae = load_visvae(args.engine, weights_file, rng)
+    specs = load_specs(visvae, rng)
+    commit = git_commit()
+    meta = {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'engine': args.engine,
+        'weights': os.path.abspath(weights_file) if weights_file else 'random',
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+    results = []
+    print('%-22s %8s %12s %12s %14s' % ('benchmark', 'size', 'best ms', 'median ms', 'per item us'))
+    for name, size, timing in list(model_benchmarks(visvae, specs, args.batch, args.repeat, rng)) + \
+            list(layout_benchmarks(visvae, specs, args.charts, args.repeat, rng)):
+        result = dict(name=name, size=size, per_item_us=timing['median_ms'] * 1000 / size, **timing)
+        results.append(result)
+        print('%-22s %8d %12.3f %12.3f %14.1f' % (name, size, result['best_ms'], result['median_ms'], result['per_item_us']))
+
+    output = args.output or os.path.join(tempfile.gettempdir(), 'bench-%s.json' % (commit[:10] if commit else 'local'))
+    with open(output, 'w') as outputs:
+        json.dump({'meta': meta, 'results': results}, outputs, indent=2)
+    print('results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare, 'r') as inputs:
+            compare(results, json.load(inputs))
+
+if __name__ == '__main__':
+    main()
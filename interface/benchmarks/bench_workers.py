@@ -0,0 +1,200 @@
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+here = os.path.dirname(os.path.abspath(__file__))
+serverdir = os.path.join(here, '..')
+specfile = os.path.join(here, '..', '..', 'sourcedata', 'vegaspecs-processed.txt')
+modelsave = os.path.join(serverdir, 'gvaemodel', 'vae_H256_D256_C444_333_L20_B200.hdf5')
+
+sys.path.insert(0, serverdir)
+
+# random weights of the trained model's shapes in the model file the server
+# loads, for hosts without a trained model; removed after the run
+def write_random_weights(seed):
+    import numpy as np
+    from bench_suite import random_weights, MAX_LEN, LATENT, rulesfile
+    from gvaemodel.vis_vae import VisVAE
+    from gvaemodel.weights import write_weights
+
+    with open(rulesfile, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+    hypers = VisVAE(None, rules, MAX_LEN, LATENT)._get_hypers(modelsave)
+    write_weights(modelsave, random_weights(len(rules), hypers, np.random.RandomState(seed)))
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as f:
+            for line in f:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except (IOError, OSError):
+        pass
+    return platform.processor()
+
+def post(url, data):
+    req = urllib.request.Request(url, data=json.dumps(data).encode('utf8'), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(req, timeout=120) as res:
+        return json.loads(res.read().decode('utf8'))
+
+def wait_ready(url, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(url + '/stats', timeout=5).read()
+            return True
+        except Exception:
+            time.sleep(1)
+    return False
+
+def children(pid):
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            if int(fields[1]) == pid:
+                pids.append(int(entry))
+        except (IOError, OSError):
+            pass
+    return pids
+
+# resident, proportional (copy-on-write pages split between sharers) and private
+# memory of a process, in MB
+def memory(pid):
+    values = {}
+    with open('/proc/%d/smaps_rollup' % pid) as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                values[parts[0][:-1]] = int(parts[1]) / 1024.0
+    return {'rss': values['Rss'], 'pss': values['Pss'], 'private': values['Private_Clean'] + values['Private_Dirty']}
+
+# each client repeatedly encodes a batch of corpus specs and decodes the result
+def load(url, specs, clients, duration, batch):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = time.time() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        while time.time() < stop:
+            chosen = rng.sample(specs, batch)
+            start = time.perf_counter()
+            try:
+                z = post(url + '/encode', chosen)
+                post(url + '/decode', z)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+            except Exception:
+                with lock:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'errors': errors[0],
+        'throughput': len(latencies) / float(duration),
+        'p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000 if latencies else None,
+    }
+
+def run(workers, args, specs):
+    port = args.port + workers
+    url = 'http://127.0.0.1:%d' % port
+    # the load is stateless, and more than one worker needs --no-sessions
+    command = [sys.executable, 'modelserver.py', '--workers', str(workers), '--port', str(port), '--no-sessions']
+    server = subprocess.Popen(command + args.server_args,
+        cwd=serverdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_ready(url, args.startup_timeout):
+            raise RuntimeError('server with %d workers did not start' % workers)
+        result = load(url, specs, args.clients, args.duration, args.batch)
+
+        pids = children(server.pid) if workers > 0 else [server.pid]
+        mem = [memory(pid) for pid in pids]
+        result['workers'] = workers
+        result['master'] = memory(server.pid) if workers > 0 else None
+        result['per_worker'] = {k: sum(m[k] for m in mem) / len(mem) for k in ('rss', 'pss', 'private')}
+        result['total_pss'] = sum(m['pss'] for m in mem) + (result['master']['pss'] if workers > 0 else 0)
+        return result
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory and throughput of modelserver.py by worker count')
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4, 8],
+        help='worker counts to measure, 0 is the single-process server')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30, metavar='SECONDS')
+    parser.add_argument('--batch', type=int, default=20, help='specs per encode/decode round trip')
+    parser.add_argument('--port', type=int, default=5100)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--output', metavar='FILE', help='also write the results as JSON')
+    parser.add_argument('--random-weights', type=int, metavar='SEED', default=None,
+        help='serve random weights of the trained model\'s shapes, when there is no trained model')
+    parser.add_argument('server_args', nargs=argparse.REMAINDER, help='extra modelserver.py arguments after --')
+    args = parser.parse_args()
+    args.server_args = [a for a in args.server_args if a != '--']
+
+    specs = []
+    with open(specfile, 'r') as inputs:
+        for line in inputs:
+            try:
+                json.loads(line)
+                specs.append(line.strip())
+            except ValueError:
+                pass
+
+    if args.random_weights is not None:
+        if os.path.exists(modelsave):
+            sys.exit('%s exists; --random-weights only stands in for a missing model' % modelsave)
+        write_random_weights(args.random_weights)
+    meta = {
+        'command': ' '.join([os.path.basename(sys.argv[0])] + sys.argv[1:]),
+        'weights': 'random, seed %d' % args.random_weights if args.random_weights is not None else os.path.abspath(modelsave),
+        'cpu': cpu_model(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+    }
+    print(', '.join('%s: %s' % item for item in meta.items()))
+
+    try:
+        results = measure(args, specs)
+    finally:
+        if args.random_weights is not None:
+            os.remove(modelsave)
+
+    if args.output:
+        with open(args.output, 'w') as outputs:
+            json.dump({'meta': meta, 'results': results}, outputs, indent=2)
+
+def measure(args, specs):
+    results = []
+    print('%8s %10s %8s %8s %10s %10s %10s %12s' % ('workers', 'req/s', 'p50 ms', 'p95 ms', 'rss MB', 'pss MB', 'priv MB', 'total pss'))
+    for workers in args.workers:
+        r = run(workers, args, specs)
+        results.append(r)
+        print('%8d %10.1f %8.1f %8.1f %10.1f %10.1f %10.1f %12.1f' % (workers, r['throughput'], r['p50_ms'] or 0, r['p95_ms'] or 0,
+            r['per_worker']['rss'], r['per_worker']['pss'], r['per_worker']['private'], r['total_pss']))
+    return results
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from layout import inverse_mds, stress
+
+LATENT = 20
+
+# targets at distances that are exactly reachable from few known charts: with 1
+# or 2 charts any distances are, so the solved stress must vanish
+def main():
+    parser = argparse.ArgumentParser(description='Check that inverse_mds reaches exact targets from few known charts')
+    parser.add_argument('--charts', type=int, nargs='+', default=[1, 2, 3])
+    parser.add_argument('--trials', type=int, default=50)
+    parser.add_argument('--tolerance', type=float, default=1e-6, help='largest accepted stress')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(5)
+    failed = False
+    for n in args.charts:
+        worst = 0.0
+        for _ in range(args.trials):
+            points = rng.normal(size=(n, LATENT))
+            targets = points.mean(axis=0) + rng.normal(size=(4, LATENT)) * 3
+            distances = np.sqrt(np.square(targets[:, None, :] - points[None, :, :]).sum(axis=-1))
+            if n <= 2:
+                distances = rng.uniform(8, 10, size=(4, n))
+            worst = max(worst, stress(inverse_mds(points, distances), points, distances).max())
+        ok = worst <= args.tolerance
+        failed |= not ok
+        print('%d known charts: worst stress %.2e %s' % (n, worst, 'ok' if ok else 'FAILED'))
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
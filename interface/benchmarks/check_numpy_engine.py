@@ -0,0 +1,83 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from gvaemodel.vis_vae import VisVAE
+
+here = os.path.dirname(os.path.abspath(__file__))
+rulesfile = os.path.join(here, '..', 'gvaemodel', 'rules-cfg.txt')
+modelsave = os.path.join(here, '..', 'gvaemodel', 'vae_H256_D256_C444_333_L20_B200.hdf5')
+specfile = os.path.join(here, '..', '..', 'sourcedata', 'vegaspecs-processed.txt')
+MAX_LEN = 20
+LATENT = 20
+
+def timeit(fn, x, repeat):
+    fn(x)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(x)
+    return (time.perf_counter() - start) / repeat * 1000
+
+# compares the encoder means and decoder outputs of the numpy engine with the
+# Keras models on corpus specs and random latent vectors, then times both
+def main():
+    parser = argparse.ArgumentParser(description='Check the numpy engine against the Keras model')
+    parser.add_argument('--specs', type=int, default=1000, help='corpus specs to encode')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest accepted absolute difference')
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    # the reference is the Keras model, so unlike the numpy engine this needs TensorFlow
+    try:
+        import gvaemodel.model_vae
+    except ImportError as e:
+        sys.exit('the Keras model cannot be loaded (%s); run this check where the packages of requirements.txt, '
+            'including TensorFlow and Keras, are installed' % e)
+
+    with open(rulesfile, 'r') as inputs:
+        rules = [line.strip() for line in inputs]
+    specs = []
+    with open(specfile, 'r') as inputs:
+        for line in inputs:
+            try:
+                json.loads(line)
+                specs.append(line.strip())
+            except ValueError:
+                pass
+    specs = specs[:args.specs]
+
+    keras_vae = VisVAE(modelsave, rules, MAX_LEN, LATENT, inference=True, engine='keras')
+    numpy_vae = VisVAE(modelsave, rules, MAX_LEN, LATENT, engine='numpy', grammar=keras_vae.grammar)
+
+    x = keras_vae._one_hot([json.loads(s) for s in specs])
+    z_keras = keras_vae.encoder_predict(x)
+    z_numpy = numpy_vae.encoder_predict(x)
+    z = np.random.RandomState(0).normal(size=(len(specs), LATENT)).astype(np.float32)
+    y_keras = keras_vae.decoder_predict(z)
+    y_numpy = numpy_vae.decoder_predict(z)
+
+    encode_error = np.abs(z_keras - z_numpy).max()
+    decode_error = np.abs(y_keras - y_numpy).max()
+    same_greedy = (keras_vae._sample_indices(y_keras, 'greedy') == numpy_vae._sample_indices(y_numpy, 'greedy')).all(axis=1).mean()
+    print('encoder max abs difference %.2e' % encode_error)
+    print('decoder max abs difference %.2e' % decode_error)
+    print('identical greedy decodings %.1f%%' % (same_greedy * 100))
+
+    print('%8s %8s %14s %14s' % ('network', 'batch', 'keras ms', 'numpy ms'))
+    for batch in [1, 64]:
+        print('%8s %8d %14.3f %14.3f' % ('encoder', batch,
+            timeit(keras_vae.encoder_predict, x[:batch], args.repeat), timeit(numpy_vae.encoder_predict, x[:batch], args.repeat)))
+        print('%8s %8d %14.3f %14.3f' % ('decoder', batch,
+            timeit(keras_vae.decoder_predict, z[:batch], args.repeat), timeit(numpy_vae.decoder_predict, z[:batch], args.repeat)))
+
+    if max(encode_error, decode_error) > args.tolerance:
+        print('numpy engine differs from the Keras model by more than %g' % args.tolerance)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
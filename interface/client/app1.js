@@ -29,6 +29,10 @@ window.app = app
 var datafile = '/data/cars.json'
 
 $(document).ready(function() {
+    // the model server keeps projection state per session
+    app.session = Math.random().toString(36).slice(2) + Date.now().toString(36)
+    $.ajaxSetup({headers: {'X-Session-Id': app.session}})
+
     var parameters = parseurl()
     if(parameters['data']) 
         datafile = parameters.data
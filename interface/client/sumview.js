@@ -14,7 +14,6 @@ import * as cql from 'compassql'
 import {SpecQueryModel} from 'compassql/build/src/model'
 import {rank} from 'compassql/build/src/ranking/ranking'
 
-import clusterfck from '../components/clusterfck/lib/clusterfck'
 import {BubbleSet, PointPath, BSplineShapeGenerator, ShapeSimplifier} from '../components/bubblesets-js/bubblesets'
 
 export default class SumView extends EventEmitter {
@@ -36,6 +35,7 @@ export default class SumView extends EventEmitter {
         this._charts = []
         this._prevcharts = []
         this._clusterNum = 1
+        this._distHandle = null
         this._bubbleSets = []
         this._variableSets = []
         this._showBubbles = true
@@ -173,10 +173,11 @@ export default class SumView extends EventEmitter {
         
         if(this._charts.length != 0)
             this._computeProjection(false, () => {
-                this._computeClusters()
-                this._createBubbles()
-                this.render()
-                if(callback) callback()
+                this._computeClusters(() => {
+                    this._createBubbles()
+                    this.render()
+                    if(callback) callback()
+                })
             })
     }
 
@@ -411,171 +412,71 @@ export default class SumView extends EventEmitter {
         this._variableSets = variablesets
     }
 
-    _visitHierarchy(node, leaves) {
-        if('value' in node) {
-            leaves.push(node.value);
-        }
-        else {
-            this._visitHierarchy(node.left, leaves);
-            this._visitHierarchy(node.right, leaves);
-        }
-	}	
-
-    _computeClusters() {
-        // clustering
-        var distances = this._computeDistanceMatrix(this._charts)
-        var hclclusters = clusterfck.hcluster(
-            this._charts.map((ch) => {return ch.chid}), 
-            (c1, c2) => {
-                var idx1 = _.findIndex(this._charts, (ch) => {return ch.chid == c1})
-                var idx2 = _.findIndex(this._charts, (ch) => {return ch.chid == c2})
-                return distances[idx1][idx2]
-            }, 
-            clusterfck.AVERAGE_LINKAGE, this._params.clthreshold)
-
-        // flatten hierarchy
-        this._clusterNum = hclclusters.length
-		hclclusters.forEach((clg, idx) => {
-			var cluster = [];
-			this._visitHierarchy(clg, cluster);
-            cluster.forEach((item) => { 
-                var chart = _.find(this._charts, (ch)=>{return ch.chid == item})
-                chart.clid = idx
-            })
-		});
-
-        // assign cluster
-        // this._charts.forEach((ch) => {
-        //     var cl = _.find(clusters, (cl) => {return cl.chid == ch.chid})
-        //     ch.clid = cl.clid
-        // })       
-    }
-
-    _computeProjection(hasembedding, callback) {
-        if(!hasembedding) {
-            var chartspecs = this._charts.map((d) => {return d.normspec})
-
-            $.ajax({
+    _computeClusters(callback) {
+        // average-linkage clusters of the distance matrix that /project kept on
+        // the server; without it (a server without sessions, or an expired
+        // handle) the server computes the matrix from the embeddings again
+        var cluster = (matrix) => {
+            return $.ajax({
                 type: 'POST',
                 crossDomain: true,
-                url: this.conf.backend + '/encode',
-                data: JSON.stringify(chartspecs),
+                url: this.conf.backend + '/cluster',
+                data: JSON.stringify(_.extend({threshold: this._params.clthreshold}, matrix)),
                 contentType: 'application/json'
-            }).then((data) => {
-                this._charts.forEach((d, i) => { d.embedding = data[i]})
-                var distances = this._computeDistanceMatrix(this._charts)
-                return $.ajax({
-                    type: 'POST',
-                    crossDomain: true,
-                    url: this.conf.backend + '/mds',
-                    data: JSON.stringify(distances),
-                    contentType: 'application/json'
-                })
-            }).then((data) => {
-                if(this._prevcharts.length <= 3)
-                    return data
-
-                var precoords = this._alignCoordinates()
-                return $.ajax({
-                    type: 'POST',
-                    crossDomain: true,
-                    url: this.conf.backend + '/orientate',
-                    data: JSON.stringify([precoords, data]),
-                    contentType: 'application/json'
-                })
-            }).done((data) => {
-                this._adjustScale(data)
-                this._charts.forEach((d, i) => {
-                    d.coords = data[i]
-                })
-                console.log(this._charts)
-                callback()
             })
         }
-        else {
-            var distances = this._computeDistanceMatrix(this._charts)
-            $.ajax({
-                type: 'POST',
-                crossDomain: true,
-                url: this.conf.backend + '/mds',
-                data: JSON.stringify(distances),
-                contentType: 'application/json'
-            }).then((data) => {
-                if(this._prevcharts.length == 0)
-                    return data
-
-                var precoords = this._alignCoordinates()
-
-                return $.ajax({
-                    type: 'POST',
-                    crossDomain: true,
-                    url: this.conf.backend + '/orientate',
-                    data: JSON.stringify([precoords, data]),
-                    contentType: 'application/json'
-                })
-            }).done((data) => {
-                this._adjustScale(data)
-                this._charts.forEach((d, i) => {
-                    d.coords = data[i]
-                })
-                console.log(this._charts)
-                if(callback) callback()
+        var embedded = () => {
+            return cluster({
+                embeddings: this._charts.map((ch) => {return ch.embedding}),
+                vars: this._charts.map((ch) => {return ch.vars}),
+                distw: this._params.distw
             })
         }
-        
-    }
-
-    _computeDistanceMatrix(charts) {
-        var distances = []
-        for(var i = 0; i < charts.length; i++) {
-            distances.push([])
-            for(var j = 0; j < charts.length; j++) {
-                if(i == j) {
-                    distances[i][j] = 0
-                }
-                else if(j < i) {
-                    distances[i][j] = distances[j][i]
-                }
-                else {
-                    distances[i][j] = this._chartDistance(charts[i], charts[j])
-                }
-            }
-        }
 
-        return distances
+        var request = this._distHandle ? cluster({handle: this._distHandle}).then(null, embedded) : embedded()
+        request.done((clids) => {
+            this._clusterNum = clids.length ? _.max(clids) + 1 : 1
+            this._charts.forEach((ch, i) => {
+                ch.clid = clids[i]
+            })
+            if(callback) callback()
+        })
     }
 
-    _chartDistance(chart1, chart2) {
-        var endist = 0
-        for(var z = 0; z < chart1.embedding.length; z++) {
-            var d = chart1.embedding[z] - chart2.embedding[z]
-            endist += d * d
+    _computeProjection(hasembedding, callback) {
+        // one request encodes (unless embeddings are known), computes distances,
+        // lays out and aligns to the previous layout
+        var prevcharts = this._prevcharts.filter((ch) => {return ch.coords})
+        var inputdata = {
+            vars: this._charts.map((ch) => {return ch.vars}),
+            distw: this._params.distw,
+            ids: this._charts.map((ch) => {return ch.chid}),
+            previous: {
+                ids: prevcharts.map((ch) => {return ch.chid}),
+                coords: prevcharts.map((ch) => {return ch.coords})
+            }
         }
-        endist = Math.sqrt(endist)
-        // variable distance - Jaccard
-        var vardist = 1 - _.intersection(chart1.vars, chart2.vars).length / 
-           _.union(chart1.vars, chart2.vars).length
-        // variable distance - Cosine
-        // var vardist = _.intersection(charts[i].vars, charts[j].vars).length / this.data.chartdata.attributes.length
-
-        return this._params.distw * endist + (1 - this._params.distw) * vardist 
-    }
+        if(hasembedding)
+            inputdata.embeddings = this._charts.map((ch) => {return ch.embedding})
+        else
+            inputdata.specs = this._charts.map((ch) => {return ch.normspec})
 
-    _alignCoordinates() {
-        var chids1 = this._prevcharts.map((ch) => {return ch.chid})
-        var chids2 = this._charts.map((ch) => {return ch.chid}) 
-        
-        var coords1 = this._prevcharts.map((ch) => {return ch.coords})
-        var newcords1 = []
-        chids2.forEach((chid) => {
-            var idx = chids1.indexOf(chid)
-            if(idx != -1)
-                newcords1.push(coords1[idx])
-            else
-                newcords1.push([0, 0])
+        $.ajax({
+            type: 'POST',
+            crossDomain: true,
+            url: this.conf.backend + '/project',
+            data: JSON.stringify(inputdata),
+            contentType: 'application/json'
+        }).done((data) => {
+            this._adjustScale(data.coords)
+            this._distHandle = data.handle
+            this._charts.forEach((d, i) => {
+                d.embedding = data.embeddings[i]
+                d.coords = data.coords[i]
+            })
+            console.log(this._charts)
+            if(callback) callback()
         })
-
-        return newcords1
     }
 
     _adjustScale(coords) {
@@ -692,7 +593,7 @@ export default class SumView extends EventEmitter {
 
         var results = rank({name:'', path:'', items:specmodels}, {'orderBy':'effectiveness'}, schema)
         var resultvlcharts = []
-        for(var i = 0; i < this._params.recnum; i++) {
+        for(var i = 0; i < Math.min(this._params.recnum, results.items.length); i++) {
             resultvlcharts.push(vlcharts[results.items[i].specQuery.id])
         }
 
@@ -703,13 +604,14 @@ export default class SumView extends EventEmitter {
         var coords = []
         var xr = this._params.recradius * (this.conf.size[0] - this.conf.margin * 2),
             yr = this._params.recradius * (this.conf.size[1] - this.conf.margin * 2)
-        for(var i = 0; i < this._params.recnum * 5; i++) {
+        // twice recnum candidates to rank; the server re-samples the slots that
+        // decode to unusable or duplicate specs
+        for(var i = 0; i < this._params.recnum * 2; i++) {
             var x = this._xscale.invert(pt[0] + xr * _.random(-1, 1, true)),
                 y = this._yscale.invert(pt[1] + yr * _.random(-1, 1, true))
             coords.push([x, y])
         }
         console.log(coords)
-        var embeddings = [], normspecs = []
 
         var edist = this._estimateDistances(coords, [this._xscale.invert(pt[0]), this._yscale.invert(pt[1])])
         var chps = this._charts.map((ch) => {return ch.embedding})
@@ -718,32 +620,16 @@ export default class SumView extends EventEmitter {
             context: this,
             type: 'POST',
             crossDomain: true,
-            url: this.conf.backend + '/invmds',    
-            //data: JSON.stringify(coords),
-            data: JSON.stringify({points: chps,  distances: edist}),
+            url: this.conf.backend + '/recommend',
+            data: JSON.stringify({points: chps, distances: edist, num: coords.length}),
             contentType: 'application/json'
-        }).then((data) => {
-            embeddings = data
-            return $.ajax({
-                context: this,
-                type: 'POST',
-                crossDomain: true,
-                url: this.conf.backend + '/decode',
-                data: JSON.stringify(data),
-                contentType: 'application/json'
-            })
         }).done((data) => {
-            normspecs = data
+            var normspecs = data.specs.map((d) => {return JSON.stringify(d)})
             console.log(data)
             var vlcharts = {}
             for(var i = 0; i < normspecs.length; i++) {
-                //if(normspecs[i] in vlcharts) continue
-                var varnum = (normspecs[i].match(/num|str/g) || []).length
-                // no variable chart skip
-                if(varnum == 0) continue
-
                 var vars = []
-                var sp = this._restoreSpec(normspecs[i], coords[i], vars)
+                var sp = this._restoreSpec(normspecs[i], coords[data.indices[i]], vars)
 
                 vlcharts[JSON.stringify(sp)] = {
                     originalspec: sp,
@@ -762,21 +648,19 @@ export default class SumView extends EventEmitter {
                 vlcharts = _.filter(vlcharts, (v, i) => {return vl[i]})
                 vlcharts = this._rankCharts(vlcharts)
 
-                for(var i = 0; i < vl.length; i++) {
-                    if(vl[i]) {
-                        var chart = {
-                            originalspec: vlcharts[i].originalspec,
-                            normspec: normspecs[vlcharts[i].index],
-                            embedding: embeddings[vlcharts[i].index],
-                            coords: coords[vlcharts[i].index],
-                            vars: vlcharts[i].vars,
-                            created: true,
-                            chid: this._charts[this._charts.length - 1].chid + 1,
-                            uid: 0
-                        }
-                        this._charts.push(chart)
+                vlcharts.forEach((vlch) => {
+                    var chart = {
+                        originalspec: vlch.originalspec,
+                        normspec: normspecs[vlch.index],
+                        embedding: data.embeddings[vlch.index],
+                        coords: coords[data.indices[vlch.index]],
+                        vars: vlch.vars,
+                        created: true,
+                        chid: this._charts[this._charts.length - 1].chid + 1,
+                        uid: 0
                     }
-                }
+                    this._charts.push(chart)
+                })
             }).finally(() => {
                 this.render()
                 this.emit('recommendchart')
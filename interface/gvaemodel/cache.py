@@ -0,0 +1,105 @@
+import collections
+import shelve
+import threading
+
+NAMESPACE_KEY = '__namespace__'
+
+# least-recently-used cache with hit/miss counters and an optional shelve file
+# that keeps entries across restarts. The file holds at most store_maxsize
+# entries (by default four times maxsize); beyond that it is rewritten with only
+# the entries in memory, i.e. the most recently used ones
+class LRUCache():
+    def __init__(self, maxsize=10000, store=None, namespace=None, store_maxsize=None):
+        self.maxsize = maxsize
+        self.store_maxsize = store_maxsize if store_maxsize is not None else 4 * maxsize
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        self._path = store
+        self._namespace = namespace
+        self._store = None
+        self._stored = 0
+        if store:
+            self._store = shelve.open(store)
+            # entries computed by a different model are stale
+            if namespace is not None and self._store.get(NAMESPACE_KEY) != namespace:
+                self._store.clear()
+                self._store[NAMESPACE_KEY] = namespace
+            self._stored = sum(1 for key in self._store.keys() if key != NAMESPACE_KEY)
+            if self._stored > self.store_maxsize:
+                self._compact()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+
+            if self._store is not None and key in self._store:
+                value = self._store[key]
+                self._insert(key, value)
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+            if self._store is not None:
+                if key not in self._store:
+                    self._stored += 1
+                self._store[key] = value
+                if self._stored > self.store_maxsize:
+                    self._compact()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            result = {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+            if self._store is not None:
+                result['stored'] = self._stored
+                result['compactions'] = self.compactions
+            return result
+
+    def close(self):
+        with self._lock:
+            if self._store is not None:
+                self._store.close()
+                self._store = None
+
+    def values(self):
+        with self._lock:
+            return list(self._data.values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _insert(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    # deleting keys does not shrink dbm files, so the store is recreated empty
+    # (flag 'n') and refilled from memory
+    def _compact(self):
+        self._store.close()
+        self._store = shelve.open(self._path, flag='n')
+        if self._namespace is not None:
+            self._store[NAMESPACE_KEY] = self._namespace
+        for key, value in self._data.items():
+            self._store[key] = value
+        self._stored = len(self._data)
+        self.compactions += 1
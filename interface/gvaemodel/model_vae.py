@@ -19,7 +19,7 @@ class ModelVAE():
 
     autoencoder = None
     
-    def create(self, rules, latent_rep_size, max_length, hypers, weights_file = None):
+    def create(self, rules, latent_rep_size, max_length, hypers, weights_file = None, weights = None):
         self.grammar = VisGrammar(rules)
         self.rules_length = len(rules)
         self.max_length = max_length
@@ -49,17 +49,43 @@ class ModelVAE():
         (z_m, z_l_v) = self._encoderMeanVar(x2, latent_rep_size, self.max_length)
         self.encoderMV = Model(inputs=x2, outputs=[z_m, z_l_v])
 
-        if weights_file:
+        if weights:
+            self.set_weights(weights)
+        elif weights_file:
             self.autoencoder.load_weights(weights_file)
             self.encoder.load_weights(weights_file, by_name = True)
             self.decoder.load_weights(weights_file, by_name = True)
             self.encoderMV.load_weights(weights_file, by_name = True)
-            
+
         adam = optimizers.Adam(lr = 0.0001)
         self.autoencoder.compile(optimizer = adam, loss = vae_loss, metrics = ['accuracy'])
         self.autoencoder.summary()
 
 
+    # serving only needs the mean encoder and the decoder: no sampling encoder,
+    # autoencoder, optimizer or loss, and the weights are read from disk once
+    def create_inference(self, rules, latent_rep_size, max_length, hypers, weights_file = None, weights = None):
+        self.rules_length = len(rules)
+        self.max_length = max_length
+        self.hypers = hypers
+        self.encoder = None
+
+        x = Input(shape=(self.max_length, self.rules_length))
+        (z_m, z_l_v) = self._encoderMeanVar(x, latent_rep_size, self.max_length)
+        self.encoderMV = Model(inputs=x, outputs=[z_m, z_l_v])
+
+        encoded_input = Input(shape=(latent_rep_size,))
+        self.decoder = Model(
+            encoded_input,
+            self._buildDecoder(encoded_input, latent_rep_size, self.max_length, self.rules_length)
+        )
+
+        if weights is None and weights_file:
+            from .weights import read_weights
+            weights = read_weights(weights_file)
+        if weights:
+            self.set_weights(weights)
+
     def _encoderMeanVar(self, x, latent_rep_size, max_length, epsilon_std = 0.01):
         h = Convolution1D(self.hypers['conv1'][0], self.hypers['conv1'][1], activation = 'relu', name='conv_1')(x)
         h = BatchNormalization(name='batch_1')(h)
@@ -135,8 +161,20 @@ class ModelVAE():
         return TimeDistributed(Dense(rules_length, activation='sigmoid'), name='decoded_mean')(h)
 
 
+    # weights already in memory, as returned by weights.read_weights
+    def set_weights(self, weights):
+        for model in [self.encoder, self.decoder, self.autoencoder, self.encoderMV]:
+            if model is None:
+                continue
+            for layer in model.layers:
+                if layer.name in weights:
+                    layer.set_weights(weights[layer.name])
+
     def save(self, filename):
         self.autoencoder.save_weights(filename)
     
-    def load(self, rules, weights_file, latent_rep_size, max_length, hypers):
-        self.create(rules, latent_rep_size = latent_rep_size, max_length = max_length, hypers = hypers, weights_file = weights_file)
+    def load(self, rules, weights_file, latent_rep_size, max_length, hypers, weights = None, inference = False):
+        if inference:
+            self.create_inference(rules, latent_rep_size = latent_rep_size, max_length = max_length, hypers = hypers, weights_file = weights_file, weights = weights)
+            return
+        self.create(rules, latent_rep_size = latent_rep_size, max_length = max_length, hypers = hypers, weights_file = weights_file, weights = weights)
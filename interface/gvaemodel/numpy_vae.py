@@ -0,0 +1,108 @@
+import numpy as np
+
+from .weights import read_weights
+
+# Keras 2 defaults of the layers that ModelVAE builds
+BATCHNORM_EPSILON = 1e-3
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+# tanh form, which does not overflow for large negative inputs
+def sigmoid(x):
+    return 0.5 * np.tanh(0.5 * x) + 0.5
+
+# the Keras 2 backend hard_sigmoid, the default GRU recurrent activation
+def hard_sigmoid(x):
+    return np.clip(0.2 * x + 0.5, 0, 1)
+
+RECURRENT_ACTIVATIONS = {'hard_sigmoid': hard_sigmoid, 'sigmoid': sigmoid}
+
+# the inference networks of ModelVAE (encoderMV's mean and the decoder) as NumPy
+# forward passes over the same weights, looked up by layer name; layer sizes come
+# from the weight shapes, so any hyperparameters of the saved model work
+class NumpyVAE():
+    def __init__(self, max_length, weights_file=None, weights=None, recurrent_activation='hard_sigmoid', dtype=np.float32):
+        if weights is None:
+            weights = read_weights(weights_file)
+        self.max_length = max_length
+        self.dtype = dtype
+        self.recurrent_activation = RECURRENT_ACTIVATIONS[recurrent_activation]
+        self.w = {name: [np.asarray(a, dtype=dtype) for a in arrays] for name, arrays in weights.items()}
+
+        # batch normalization in inference mode is an affine map, folded once
+        self.bn = {}
+        for name in ['batch_1', 'batch_2', 'batch_3', 'batch_4']:
+            gamma, beta, mean, var = self.w[name]
+            scale = gamma / np.sqrt(var + BATCHNORM_EPSILON)
+            self.bn[name] = (scale, beta - mean * scale)
+
+    # z_mean for a batch of one-hot production sequences
+    def encode_mean(self, x):
+        h = np.asarray(x, dtype=self.dtype)
+        for conv, bn in [('conv_1', 'batch_1'), ('conv_2', 'batch_2'), ('conv_3', 'batch_3')]:
+            h = self._batchnorm(relu(self._conv1d(h, *self.w[conv])), bn)
+        h = h.reshape(h.shape[0], -1)
+        h = relu(self._dense(h, *self.w['dense_1']))
+        return self._dense(h, *self.w['z_mean'])
+
+    # sigmoid production scores, batch x max_length x rules
+    def decode(self, z):
+        h = self._batchnorm(np.asarray(z, dtype=self.dtype), 'batch_4')
+        h = relu(self._dense(h, *self.w['latent_input']))
+
+        # RepeatVector feeds the same input at every step, so the first layer
+        # projects it once
+        x = self._dense(h, self.w['gru_1'][0], self._input_bias('gru_1'))
+        h = self._gru(np.broadcast_to(x[:, None, :], (x.shape[0], self.max_length, x.shape[1])), 'gru_1')
+        for name in ['gru_2', 'gru_3']:
+            h = self._gru(self._dense(h, self.w[name][0], self._input_bias(name)), name)
+
+        return sigmoid(self._dense(h, *self.w['decoded_mean']))
+
+    def _dense(self, x, kernel, bias):
+        return np.matmul(x, kernel) + bias
+
+    def _batchnorm(self, x, name):
+        scale, shift = self.bn[name]
+        return x * scale + shift
+
+    # 'valid' Conv1D as a sum of one matrix product per kernel tap
+    def _conv1d(self, x, kernel, bias):
+        k = kernel.shape[0]
+        steps = x.shape[1] - k + 1
+        out = np.matmul(x[:, :steps, :], kernel[0])
+        for j in range(1, k):
+            out += np.matmul(x[:, j:j + steps, :], kernel[j])
+        return out + bias
+
+    # GRU weights are [kernel, recurrent_kernel, bias] with gates in z, r, h order;
+    # with reset_after the bias has a second row for the recurrent projection
+    def _input_bias(self, name):
+        bias = self.w[name][2]
+        return bias[0] if bias.ndim == 2 else bias
+
+    # a return_sequences GRU over inputs that are already multiplied by the kernel
+    def _gru(self, x, name):
+        _, recurrent_kernel, bias = self.w[name]
+        units = recurrent_kernel.shape[0]
+        reset_after = bias.ndim == 2
+        u_zr, u_h = recurrent_kernel[:, :2 * units], recurrent_kernel[:, 2 * units:]
+
+        h = np.zeros((x.shape[0], units), dtype=self.dtype)
+        out = np.empty((x.shape[0], x.shape[1], units), dtype=self.dtype)
+        for t in range(x.shape[1]):
+            x_zr, x_h = x[:, t, :2 * units], x[:, t, 2 * units:]
+            if reset_after:
+                inner = np.matmul(h, recurrent_kernel) + bias[1]
+                zr = self.recurrent_activation(x_zr + inner[:, :2 * units])
+                r = zr[:, units:]
+                hh = np.tanh(x_h + r * inner[:, 2 * units:])
+            else:
+                zr = self.recurrent_activation(x_zr + np.matmul(h, u_zr))
+                r = zr[:, units:]
+                hh = np.tanh(x_h + np.matmul(r * h, u_h))
+            z = zr[:, :units]
+            h = z * h + (1 - z) * hh
+            out[:, t] = h
+        return out
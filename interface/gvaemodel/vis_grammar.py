@@ -1,43 +1,119 @@
-import nltk
+import hashlib
+import os
+import shutil
+import tempfile
 import six
 import numpy as np
 
+# bump when the compiled tables change, so older artifacts are not reused
+COMPILED_VERSION = 1
+COMPILED_ARRAYS = ('lhs_list', 'masks', 'rhs_index', 'rhs_count', 'ind_of_ind', 'child_names', 'child_offsets', 'terminals', 'is_terminal')
+
+# key of a compiled grammar: the rules text and the table format
+def rules_hash(rules):
+    digest = hashlib.sha256(('%d\n' % COMPILED_VERSION + '\n'.join(rules)).encode('utf8'))
+    return digest.hexdigest()[:16]
+
 class VisGrammar():
-    def __init__(self, rules):
-        # form the CFG and get the start symbol
-        self.GCFG = nltk.CFG.fromstring('\n'.join(rules))
+    # with cache_dir, the tables are read from (or on first use written to) a
+    # compiled artifact there, a directory of .npy files that is memory-mapped and
+    # needs no nltk
+    def __init__(self, rules, cache_dir=None):
+        self.rules = rules
         self.start_index = 'root'
+        self._cfg = None
 
-        # collect all lhs symbols, and the unique set of them
-        all_lhs = [a.lhs().symbol() for a in self.GCFG.productions()]
-        self.lhs_list = []
-        for a in all_lhs:
-            if a not in self.lhs_list:
-                self.lhs_list.append(a)
+        path = os.path.join(cache_dir, 'grammar-' + rules_hash(rules)) if cache_dir else None
+        if path is not None and os.path.isdir(path):
+            self._load(path)
+            return
+
+        self._compile()
+        if path is not None:
+            self._save(cache_dir, path)
 
-        D = len(self.GCFG.productions())
+    # the nltk grammar, parsed when first needed; nltk is slow to import
+    @property
+    def GCFG(self):
+        if self._cfg is None:
+            import nltk
+            self._cfg = nltk.CFG.fromstring('\n'.join(self.rules))
+        return self._cfg
+
+    def _compile(self):
+        productions = self.GCFG.productions()
+        D = len(productions)
+
+        # collect all lhs symbols, and the unique set of them in order of appearance
+        all_lhs = [a.lhs().symbol() for a in productions]
+        lhs_position = {}
+        for a in all_lhs:
+            lhs_position.setdefault(a, len(lhs_position))
+        self.lhs_list = list(lhs_position)
 
         # this map tells us the rhs symbol indices for each production rule
-        self.rhs_map = [None] * D
-        count = 0
-        for a in self.GCFG.productions():
-            self.rhs_map[count] = []
-            for b in a.rhs():
-                if not isinstance(b, six.string_types):
-                    s = b.symbol()
-                    self.rhs_map[count].extend(list(np.where(np.array(self.lhs_list) == s)[0]))
-            count = count + 1
-
-        # this tells us for each lhs symbol which productions rules should be masked
+        self.rhs_map = []
+        for a in productions:
+            symbols = [b.symbol() for b in a.rhs() if not isinstance(b, six.string_types)]
+            self.rhs_map.append([lhs_position[s] for s in symbols if s in lhs_position])
+
+        # padded array form of rhs_map, with the rhs symbols stored in reverse so
+        # that pushing a row onto a stack leaves the leftmost symbol on top
+        self.rhs_count = np.array([len(a) for a in self.rhs_map], dtype=np.int32)
+        self.rhs_index = np.zeros((D, max(1, self.rhs_count.max())), dtype=np.int32)
+        for i, a in enumerate(self.rhs_map):
+            self.rhs_index[i, :len(a)] = a[::-1]
+
+        # this tells us for each lhs symbol which productions rules should be masked,
+        # and for each production the index of its lhs
+        self.ind_of_ind = np.array([lhs_position[a] for a in all_lhs])
         self.masks = np.zeros((len(self.lhs_list), D))
-        count = 0
-        for sym in self.lhs_list:
-            is_in = np.array([a == sym for a in all_lhs], dtype=int).reshape(1,-1)
-            self.masks[count] = is_in
-            count = count + 1
-
-        # this tells us the indices where the masks are equal to 1
-        index_array = []
-        for i in range(self.masks.shape[1]):
-            index_array.append(np.where(self.masks[:,i]==1)[0][0])
-        self.ind_of_ind = np.array(index_array)
\ No newline at end of file
+        self.masks[self.ind_of_ind, np.arange(D)] = 1
+
+        # what SpecBuilder needs of every production: its child keys and its value
+        self.children = []
+        self.terminals = []
+        for prod in productions:
+            self.children.append([str(a) for a in prod.rhs() if not isinstance(a, six.string_types) and str(a) != 'None'])
+            terminals = [str(a) for a in prod.rhs() if isinstance(a, six.string_types) and str(a) != '+']
+            self.terminals.append(terminals[0] if terminals else None)
+
+    # written to a temporary directory and renamed into place, so concurrent
+    # starts never read a partial artifact
+    def _save(self, cache_dir, path):
+        children = [c for cs in self.children for c in cs]
+        arrays = {
+            'lhs_list': np.array(self.lhs_list, dtype=np.str_),
+            'masks': self.masks,
+            'rhs_index': self.rhs_index,
+            'rhs_count': self.rhs_count,
+            'ind_of_ind': self.ind_of_ind,
+            'child_names': np.array(children, dtype=np.str_).reshape(len(children)),
+            'child_offsets': np.cumsum([0] + [len(cs) for cs in self.children]).astype(np.int64),
+            'terminals': np.array([t if t is not None else '' for t in self.terminals], dtype=np.str_),
+            'is_terminal': np.array([t is not None for t in self.terminals], dtype=bool),
+        }
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = tempfile.mkdtemp(dir=cache_dir)
+        try:
+            for name in COMPILED_ARRAYS:
+                np.save(os.path.join(tmp, name + '.npy'), arrays[name])
+            os.rename(tmp, path)
+        except OSError:
+            # another process saved the same artifact first
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def _load(self, path):
+        a = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in COMPILED_ARRAYS}
+        self.lhs_list = [str(s) for s in a['lhs_list']]
+        self.masks = a['masks']
+        self.rhs_index = a['rhs_index']
+        self.rhs_count = a['rhs_count']
+        self.ind_of_ind = a['ind_of_ind']
+        self.rhs_map = [list(self.rhs_index[i, :n][::-1]) for i, n in enumerate(self.rhs_count)]
+
+        names, offsets = a['child_names'], a['child_offsets']
+        self.children = [[str(s) for s in names[offsets[i]:offsets[i + 1]]] for i in range(len(offsets) - 1)]
+        self.terminals = [str(t) if is_terminal else None for t, is_terminal in zip(a['terminals'], a['is_terminal'])]
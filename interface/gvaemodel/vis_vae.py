@@ -1,11 +1,13 @@
 import simplejson as json
 import re
 import numpy as np
-import nltk
 
-from .model_vae import ModelVAE
 from .vis_grammar import VisGrammar
 
+DECODE_MODES = ('sample', 'greedy', 'seeded', 'beam')
+BEAM_WIDTH = 5
+ENGINES = ('keras', 'numpy')
+
 def get_rules(node, parentkey, rules):
     thisrule = parentkey + ' -> ' + ' "+" '.join(sorted(node.keys()))
     rules.append(thisrule)
@@ -17,65 +19,125 @@ def get_rules(node, parentkey, rules):
         else:
             rules.append(k + ' -> ' + '"' + str(v) + '"')
 
-def get_specs(rules):
-    spectree = {'name':'root', 'parent':None}
-    Q = [spectree]
-
-    for r in rules:  
-        for node in filter(lambda x: x['name'] == str(r.lhs()), Q):
-            for symbol in r.rhs():
-                symbol_name = str(symbol)
-                if type(symbol) == nltk.grammar.Nonterminal:
-                    node[symbol_name] = {'name':symbol_name, 'parent':node}
-                    Q.append(node[symbol_name])
-                elif symbol_name != '+':
-                    if symbol_name == 'True':
-                        node['parent'][node['name']] = True
-                    elif symbol_name == 'False':
-                        node['parent'][node['name']] = False
-                    else:
-                        try:
-                            node['parent'][node['name']] = float(symbol_name)
-                        except:
-                            node['parent'][node['name']] = symbol_name
-    
-    clean_tree(Q[0])
-    return json.dumps(Q[0])    
-
-def clean_tree(node):
-    del node['parent']
-    del node['name']
-
-    for k, v in node.items():
-        if type(v) is dict:
-            clean_tree(v)
+# builds specs from production index sequences by expanding the leftmost open
+# nonterminal, i.e. replaying the derivation that get_rules records
+class SpecBuilder():
+    def __init__(self, grammar):
+        self.children = grammar.children
+        self.terminal = [t is not None for t in grammar.terminals]
+        self.values = [self._parse_value(t) if t is not None else None for t in grammar.terminals]
+
+    def build(self, indices, as_json=True):
+        specs = []
+        for row in np.asarray(indices).tolist():
+            holder = {'root': {}}
+            stack = [(holder, 'root')]
+            for ix in row:
+                if not stack:
+                    break
+                parent, key = stack.pop()
+                if self.terminal[ix]:
+                    parent[key] = self.values[ix]
+                else:
+                    node = parent[key]
+                    for name in self.children[ix]:
+                        node[name] = {}
+                    stack.extend((node, name) for name in reversed(self.children[ix]))
+
+            specs.append(json.dumps(holder['root']) if as_json else holder['root'])
+        return specs
+
+    def _parse_value(self, symbol_name):
+        if symbol_name == 'True':
+            return True
+        elif symbol_name == 'False':
+            return False
+        try:
+            return float(symbol_name)
+        except ValueError:
+            return symbol_name
 
 class VisVAE():
-    def __init__(self, weights_file, rules, max_len, latent_dim):
+    def __init__(self, weights_file, rules, max_len, latent_dim, encode_cache=None, decode_cache=None, decode_quantum=1e-3, weights=None, grammar=None, inference=False, engine='keras'):
         self.rules = rules
         self.max_len = max_len
         self.input_dim = len(rules)
         self.latent_dim = latent_dim
+        self.encode_cache = encode_cache
+        self.decode_cache = decode_cache
+        self.decode_quantum = decode_quantum
 
         self.rule2index = {}
         for i, r in enumerate(rules):
             self.rule2index[r] = i
 
-        self.grammar = VisGrammar(rules)
-        self.productions = self.grammar.GCFG.productions()
+        self.grammar = grammar if grammar is not None else VisGrammar(rules)
+        self.spec_builder = SpecBuilder(self.grammar)
         self.lhs_map = {}
         for ix, lhs in enumerate(self.grammar.lhs_list):
             self.lhs_map[lhs] = ix
 
-        hypers = self._get_hypers(weights_file)
-        self.vae = ModelVAE()
-        self.vae.load(self.rules, weights_file, max_length=self.max_len, latent_rep_size=self.latent_dim, hypers=hypers)
+        # tables for the vectorized sampler: an empty stack yields 'Nothing', whose
+        # only production pads the rest of the sequence
+        self.start_lhs = self.lhs_map[self.grammar.start_index]
+        self.nothing_lhs = self.lhs_map['Nothing']
+        self.nothing_index = int(np.argmax(self.grammar.masks[self.nothing_lhs]))
+        self.stack_depth = 1 + self.max_len * self.grammar.rhs_index.shape[1]
+
+        # a model without weights only supports grammar operations; an inference
+        # model has only the networks behind encode and decode, and the numpy engine
+        # runs them without TensorFlow
+        self.vae = None
+        if weights_file is not None and engine == 'numpy':
+            from .numpy_vae import NumpyVAE
+            self.vae = NumpyVAE(self.max_len, weights_file, weights=weights)
+
+            self.encoder_predict = self.vae.encode_mean
+            self.decoder_predict = self.vae.decode
+        elif weights_file is not None:
+            from .model_vae import ModelVAE
+            hypers = self._get_hypers(weights_file)
+            self.vae = ModelVAE()
+            self.vae.load(self.rules, weights_file, max_length=self.max_len, latent_rep_size=self.latent_dim, hypers=hypers, weights=weights, inference=inference)
+
+            # the network calls behind encode and decode; a server may replace them,
+            # e.g. with batching versions
+            self.encoder_predict = lambda x: self.vae.encoderMV.predict(x)[0]
+            self.decoder_predict = self.vae.decoder.predict
 
     def encode(self, sentences):
-        one_hot = np.zeros((len(sentences), self.max_len, self.input_dim), dtype=np.float32)
+        # specs are keyed by their sorted-key JSON, so key order and whitespace
+        # differences share one entry; only the distinct misses reach the encoder
+        json_objs = [json.loads(sentence) for sentence in sentences]
+        keys = [json.dumps(json_obj, sort_keys=True) for json_obj in json_objs]
+
+        unique = {}
+        for key, json_obj in zip(keys, json_objs):
+            unique.setdefault(key, json_obj)
 
-        for i, sentence in enumerate(sentences):
-            json_obj = json.loads(sentence)
+        found = {}
+        if self.encode_cache is not None:
+            for key in unique:
+                z = self.encode_cache.get(key)
+                if z is not None:
+                    found[key] = z
+
+        missing = [key for key in unique if key not in found]
+        if len(missing) > 0:
+            one_hot = self._one_hot([unique[key] for key in missing])
+            z = self.encoder_predict(one_hot)
+            for key, zi in zip(missing, z):
+                zi = np.array(zi)
+                found[key] = zi
+                if self.encode_cache is not None:
+                    self.encode_cache.put(key, zi)
+
+        return np.array([found[key] for key in keys], dtype=np.float32).reshape(len(keys), self.latent_dim)
+
+    def _one_hot(self, json_objs):
+        one_hot = np.zeros((len(json_objs), self.max_len, self.input_dim), dtype=np.float32)
+
+        for i, json_obj in enumerate(json_objs):
             sentence_rules = [] 
             get_rules(json_obj, 'root', sentence_rules)
             indices = [self.rule2index[r] for r in sentence_rules]
@@ -83,51 +145,172 @@ class VisVAE():
             one_hot[i][np.arange(len(indices)), indices] = 1
             one_hot[i][np.arange(len(indices), self.max_len), -1] = 1
 
-        self.one_hot = one_hot
-        return self.vae.encoderMV.predict(one_hot)[0]
+        return one_hot
 
-    def decode(self, z):
+    def decode(self, z, as_json=True, mode='sample', seed=None):
         assert z.ndim == 2
-        unmasked = self.vae.decoder.predict(z)
-        X_hat = self._sample_using_masks(unmasked)
+        if mode not in DECODE_MODES:
+            raise ValueError('unknown decode mode: ' + str(mode))
+        if mode == 'seeded' and seed is None:
+            seed = 0
 
-        # Convert from one-hot to sequence of production rules
-        prod_seq = [[self.productions[X_hat[index, t].argmax()] for t in range(X_hat.shape[1])] 
-            for index in range(X_hat.shape[0])]
-        return [get_specs(prods) for prods in prod_seq]
+        if mode == 'sample' or self.decode_cache is None:
+            return self.sample_specs(self.decode_logits(z), as_json, mode, seed)
 
-    def _sample_using_masks(self, unmasked):
-        eps = 1e-100
+        # deterministic modes decode the quantized latent vector, so the cached
+        # result is a function of the key alone
+        q = np.round(np.asarray(z, dtype=np.float64) / self.decode_quantum).astype(np.int64)
+        keys = ['%s:%s:%s' % (mode, seed, row.tobytes().hex()) for row in q]
+
+        found = {}
+        missing = {}
+        for i, key in enumerate(keys):
+            if key in found or key in missing:
+                continue
+            cached = self.decode_cache.get(key)
+            if cached is not None:
+                found[key] = cached
+            else:
+                missing[key] = i
+
+        if len(missing) > 0:
+            rows = list(missing.values())
+            unmasked = self.decode_logits((q[rows] * self.decode_quantum).astype(np.float32))
+            indices = self._sample_indices(unmasked, mode, seed)
+            for key, row in zip(missing, indices):
+                found[key] = row
+                self.decode_cache.put(key, row)
+
+        return self.spec_builder.build([found[key] for key in keys], as_json)
+
+    # the k most likely grammar-valid production sequences of every latent vector,
+    # as lists of specs and their log-probabilities, best first; all candidates
+    # come from one decoder call, or from decoder outputs already computed
+    def decode_beam(self, z, k=BEAM_WIDTH, as_json=True):
+        return self.beam_specs(self.decode_logits(z), k, as_json)
+
+    def beam_specs(self, unmasked, k=BEAM_WIDTH, as_json=True):
+        indices, scores = self._beam_indices(unmasked, k)
+        # fewer than k valid sequences leave beams with no probability
+        valid = np.isfinite(scores)
+        specs = iter(self.spec_builder.build(indices[valid], as_json))
+        return [[next(specs) for _ in range(n)] for n in valid.sum(axis=1)], \
+            [[float(v) for v in row[np.isfinite(row)]] for row in scores]
+
+    def decode_logits(self, z):
+        return self.decoder_predict(z)
+
+    # draws specs from decoder outputs; sampling again from the same logits gives
+    # new candidates without rerunning the decoder
+    def sample_specs(self, unmasked, as_json=True, mode='sample', seed=None):
+        return self.spec_builder.build(self._sample_indices(unmasked, mode, seed), as_json)
+
+    def _sample_using_masks(self, unmasked, mode='sample', seed=None):
+        indices = self._sample_indices(unmasked, mode, seed)
         X_hat = np.zeros_like(unmasked)
+        X_hat[np.arange(indices.shape[0])[:, None], np.arange(indices.shape[1]), indices] = 1.0
+        return X_hat
+
+    def _sample_indices(self, unmasked, mode='sample', seed=None):
+        if mode == 'beam':
+            return self._beam_indices(unmasked, BEAM_WIDTH)[0][:, 0]
+
+        eps = 1e-100
+        batch, steps = unmasked.shape[0], unmasked.shape[1]
+        rows = np.arange(batch)
+        indices = np.full((batch, steps), self.nothing_index, dtype=np.int32)
+
+        # seeded mode shares one uniform per step across the batch, so each row
+        # depends only on its own logits and the seed
+        if mode == 'seeded':
+            uniforms = np.random.RandomState(seed).random_sample(steps)
 
-        # Create a stack for each input in the batch
-        S = np.empty((unmasked.shape[0],), dtype=object)
-        for ix in range(S.shape[0]):
-            S[ix] = [str(self.grammar.start_index)]
+        # Keep the stacks of all inputs in one array, with a stack pointer per row
+        S = np.zeros((batch, self.stack_depth), dtype=np.int32)
+        S[:, 0] = self.start_lhs
+        top = np.ones(batch, dtype=np.int32)
+        offsets = np.arange(self.grammar.rhs_index.shape[1])
 
         # Loop over time axis, sampling values and updating masks
-        for t in range(unmasked.shape[1]):
-            next_nonterminal = [self.lhs_map[self._pop_or_nothing(a)] for a in S]
+        for t in range(steps):
+            nonempty = top > 0
+            # once every stack is empty only 'Nothing' can follow, so the padding
+            # already in place is the result
+            if not nonempty.any():
+                break
+            top -= nonempty
+            next_nonterminal = np.where(nonempty, S[rows, top], self.nothing_lhs)
             mask = self.grammar.masks[next_nonterminal]
-            masked_output = np.exp(unmasked[:, t ,:]) * mask + eps
-            sampled_output = np.argmax(np.random.gumbel(size=masked_output.shape) + np.log(masked_output), axis=-1)
-            #sampled_output = np.argmax(np.log(masked_output), axis=-1)
-            X_hat[np.arange(unmasked.shape[0]), t, sampled_output] = 1.0
-
-            # Identify non-terminals in RHS of selected production, and
-            # push them onto the stack in reverse order
-            rhs = [filter(lambda a: (type(a) == nltk.grammar.Nonterminal) and (str(a) != 'None'), self.productions[i].rhs()) 
-                for i in sampled_output]
-            for ix in range(S.shape[0]):
-                S[ix].extend(list(map(str, rhs[ix]))[::-1])
+            masked_output = np.exp(unmasked[:, t, :]) * mask + eps
+            # inverse-CDF draw from masked_output, the same distribution as taking the
+            # argmax over Gumbel-perturbed logits but with one uniform per row
+            if mode == 'greedy':
+                sampled_output = np.argmax(masked_output, axis=-1)
+            else:
+                cdf = np.cumsum(masked_output, axis=-1)
+                u = uniforms[t] if mode == 'seeded' else np.random.random_sample(batch)
+                sampled_output = np.minimum((cdf <= (u * cdf[:, -1])[:, None]).sum(axis=-1), cdf.shape[1] - 1)
+            indices[:, t] = sampled_output
 
-        return X_hat
+            # Push the non-terminals in RHS of selected production onto the stack,
+            # in reverse order
+            count = self.grammar.rhs_count[sampled_output]
+            pushed = offsets < count[:, None]
+            pos = top[:, None] + offsets
+            S[np.nonzero(pushed)[0], pos[pushed]] = self.grammar.rhs_index[sampled_output][pushed]
+            top += count
+
+        return indices
+
+    # beam search over the masked decoder distributions that _sample_indices draws
+    # from; the k beams of every input are rows of one stack array, expanded
+    # together at each step. Finished beams can only continue with 'Nothing', at no
+    # cost, and beams still open after the last step rank below finished ones
+    def _beam_indices(self, unmasked, k):
+        batch, steps, dim = unmasked.shape
+        n = batch * k
+        rows = np.arange(n)
+        indices = np.full((n, steps), self.nothing_index, dtype=np.int32)
+
+        # only the first beam is live at the start, so no two beams ever share a prefix
+        scores = np.full((batch, k), -np.inf)
+        scores[:, 0] = 0
+        S = np.zeros((n, self.stack_depth), dtype=np.int32)
+        S[:, 0] = self.start_lhs
+        top = np.ones(n, dtype=np.int32)
+        offsets = np.arange(self.grammar.rhs_index.shape[1])
+
+        for t in range(steps):
+            nonempty = top > 0
+            if not nonempty.any():
+                break
+            top -= nonempty
+            next_nonterminal = np.where(nonempty, S[rows, top], self.nothing_lhs)
+            mask = self.grammar.masks[next_nonterminal] > 0
+            logits = np.repeat(unmasked[:, t, :], k, axis=0)
+            norm = np.log((np.exp(logits) * mask).sum(axis=-1, keepdims=True))
+            logp = np.where(mask, logits - norm, -np.inf)
+
+            # the k best extensions of all beams of an input
+            candidates = (scores.reshape(n, 1) + logp).reshape(batch, k * dim)
+            best = np.argsort(-candidates, axis=1, kind='stable')[:, :k]
+            scores = np.take_along_axis(candidates, best, axis=1)
+
+            parent = (np.arange(batch)[:, None] * k + best // dim).ravel()
+            chosen = (best % dim).ravel().astype(np.int32)
+            S, top, indices = S[parent], top[parent], indices[parent]
+            indices[:, t] = chosen
+
+            count = self.grammar.rhs_count[chosen]
+            pushed = offsets < count[:, None]
+            pos = top[:, None] + offsets
+            S[np.nonzero(pushed)[0], pos[pushed]] = self.grammar.rhs_index[chosen][pushed]
+            top += count
 
-    def _pop_or_nothing(self, S):
-        try: 
-            return S.pop()
-        except: 
-            return 'Nothing' 
+        unfinished = (top > 0).reshape(batch, k)
+        order = np.lexsort((-scores, unfinished), axis=1)
+        indices = indices.reshape(batch, k, steps)
+        return np.take_along_axis(indices, order[:, :, None], axis=1), np.take_along_axis(scores, order, axis=1)
 
     def _get_hypers(self, filename):
         hypers = {}
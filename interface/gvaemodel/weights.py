@@ -0,0 +1,33 @@
+import h5py
+import numpy as np
+
+# weights of a Keras HDF5 file, either a full model save or save_weights output,
+# as {layer name: [arrays in layer.get_weights() order]}
+def read_weights(weights_file):
+    weights = {}
+    with h5py.File(weights_file, 'r') as h5f:
+        f = h5f
+        if 'layer_names' not in f.attrs and 'model_weights' in f:
+            f = f['model_weights']
+
+        for name in f.attrs['layer_names']:
+            name = _as_str(name)
+            g = f[name]
+            weight_names = [_as_str(n) for n in g.attrs['weight_names']]
+            if len(weight_names) > 0:
+                weights[name] = [np.asarray(g[n]) for n in weight_names]
+    return weights
+
+def _as_str(s):
+    return s.decode('utf8') if isinstance(s, bytes) else s
+
+# the inverse of read_weights, in the layout of Keras' save_weights
+def write_weights(weights_file, weights):
+    with h5py.File(weights_file, 'w') as h5f:
+        h5f.attrs['layer_names'] = [name.encode('utf8') for name in weights]
+        for name, arrays in weights.items():
+            g = h5f.create_group(name)
+            weight_names = ['%s/weight_%d:0' % (name, i) for i in range(len(arrays))]
+            g.attrs['weight_names'] = [n.encode('utf8') for n in weight_names]
+            for n, a in zip(weight_names, arrays):
+                g.create_dataset(n, data=a)
@@ -0,0 +1,207 @@
+import numpy as np
+
+# combined chart distance of SumView._chartDistance for all pairs: distw times
+# the euclidean distance between embeddings plus (1 - distw) times the Jaccard
+# distance between the sets of data variables
+def chart_distances(embeddings, variables, distw):
+    from scipy.spatial.distance import pdist, squareform
+    endist = squareform(pdist(np.asarray(embeddings, dtype=np.float64)))
+
+    # one indicator row per chart, so intersections are a single matrix product
+    vocabulary = {}
+    for vs in variables:
+        for v in vs:
+            vocabulary.setdefault(v, len(vocabulary))
+    B = np.zeros((len(variables), max(1, len(vocabulary))), dtype=np.float32)
+    for i, vs in enumerate(variables):
+        B[i, [vocabulary[v] for v in vs]] = 1
+
+    inter = B.dot(B.T).astype(np.float64)
+    sizes = B.sum(axis=1).astype(np.float64)
+    union = sizes[:, None] + sizes[None, :] - inter
+    vardist = 1 - np.divide(inter, union, out=np.ones_like(inter), where=union > 0)
+
+    distances = distw * endist + (1 - distw) * vardist
+    np.fill_diagonal(distances, 0)
+    return distances
+
+# start each target at a blend of the embeddings it should be closest to,
+# weighted by inverse target distance
+def warm_start(points, distances, neighbors=3):
+    k = min(neighbors, points.shape[0])
+    nearest = np.argsort(distances, axis=1)[:, :k]
+    weights = 1.0 / (np.maximum(np.take_along_axis(distances, nearest, axis=1), 0) + 1e-6)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum('mj,mjk->mk', weights, points[nearest])
+
+# a blend of the points lies in their affine hull; with no more points than
+# dimensions the hull is a proper subspace and the stress gradient has no part
+# off it, so a solution off the hull is never reached. Moves every start in a
+# random direction orthogonal to the hull, by the height that puts it at its
+# target distance from the nearest point
+def off_hull(x, points, distances, rng):
+    centered = points - points.mean(axis=0)
+    _, s, vt = np.linalg.svd(centered, full_matrices=False)
+    basis = vt[s > 1e-9 * max(1.0, s.max())]
+
+    u = rng.normal(size=x.shape)
+    u -= u.dot(basis.T).dot(basis)
+    u /= np.maximum(np.linalg.norm(u, axis=1, keepdims=True), 1e-12)
+
+    nearest = np.argmin(distances, axis=1)
+    dmin = distances[np.arange(x.shape[0]), nearest]
+    along = np.square(x - points[nearest]).sum(axis=1)
+    height = np.sqrt(np.maximum(np.square(dmin) - along, 0)) + 1e-3 * np.maximum(dmin, 1e-6)
+    return x + u * height[:, None]
+
+# sum of squared differences between the distances from x to the points and the
+# target distances, for every row of x and distances
+def stress(x, points, distances):
+    d = np.sqrt(np.square(x[:, None, :] - points[None, :, :]).sum(axis=-1))
+    return np.square(d - distances).sum(axis=-1)
+
+# find, for every row of distances, a vector whose distances to points match it
+# in the least-squares sense; all rows are solved together with a batched
+# Levenberg-Marquardt iteration on the analytic Jacobian
+def inverse_mds(points, distances, x0=None, max_iter=500, tol=1e-9, seed=0):
+    points = np.asarray(points, dtype=np.float64)
+    distances = np.atleast_2d(np.asarray(distances, dtype=np.float64))
+
+    if x0 is None:
+        x = warm_start(points, distances)
+        if points.shape[0] <= points.shape[1]:
+            x = off_hull(x, points, distances, np.random.RandomState(seed))
+    else:
+        x = np.array(x0, dtype=np.float64)
+    f = stress(x, points, distances)
+    damping = np.full(x.shape[0], 1e-3)
+    active = np.ones(x.shape[0], dtype=bool)
+    eye = np.eye(points.shape[1])
+
+    for _ in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+
+        diff = x[idx, None, :] - points[None, :, :]
+        norm = np.maximum(np.sqrt(np.square(diff).sum(axis=-1)), 1e-12)
+        jac = diff / norm[..., None]
+        resid = norm - distances[idx]
+        grad = np.einsum('ank,an->ak', jac, resid)
+        hess = np.einsum('ank,anl->akl', jac, jac)
+
+        step = np.linalg.solve(hess + damping[idx, None, None] * eye, -grad[..., None])[..., 0]
+        x_new = x[idx] + step
+        f_new = stress(x_new, points, distances[idx])
+
+        better = f_new < f[idx]
+        gain = np.where(better, f[idx] - f_new, 0)
+        x[idx[better]] = x_new[better]
+        f[idx[better]] = f_new[better]
+        damping[idx] = np.where(better, damping[idx] * 0.3, damping[idx] * 10)
+
+        converged = (2 * np.abs(grad).max(axis=1) < tol) \
+            | (better & (gain <= tol * np.maximum(f[idx], tol))) \
+            | (damping[idx] > 1e12)
+        active[idx[converged]] = False
+
+    return x
+
+# classical (Torgerson) scaling, used to start SMACOF when there is no prior layout
+def classical_mds(dissimilarities, n_components=2):
+    n = dissimilarities.shape[0]
+    J = np.eye(n) - 1.0 / n
+    B = -0.5 * J.dot(np.square(dissimilarities)).dot(J)
+    w, v = np.linalg.eigh(B)
+    order = np.argsort(w)[::-1][:n_components]
+    return v[:, order] * np.sqrt(np.maximum(w[order], 0))
+
+# metric SMACOF from a given start, stopping once an iteration improves the raw
+# stress by less than a fraction eps of it
+def smacof(dissimilarities, init, max_iter=3000, eps=1e-6):
+    n = dissimilarities.shape[0]
+    X = np.array(init, dtype=np.float64)
+    old_stress = None
+    iteration = 0
+
+    for iteration in range(1, max_iter + 1):
+        dis = np.sqrt(np.square(X[:, None, :] - X[None, :, :]).sum(axis=-1))
+        stress = np.square(dis - dissimilarities).sum() / 2
+
+        # Guttman transform
+        ratio = np.divide(dissimilarities, dis, out=np.zeros_like(dis), where=dis != 0)
+        B = -ratio
+        B[np.arange(n), np.arange(n)] += ratio.sum(axis=1)
+        X = B.dot(X) / n
+
+        if old_stress is not None and old_stress - stress <= eps * old_stress:
+            break
+        old_stress = stress
+
+    return X, stress, iteration
+
+# similarity transform (rotation/reflection, uniform scale, translation) of X that
+# best matches Y on the given rows, applied to all of X
+def align(X, Y, rows):
+    Xr = X[rows]
+    mx, my = Xr.mean(axis=0), Y.mean(axis=0)
+    U, s, Vt = np.linalg.svd((Xr - mx).T.dot(Y - my))
+    R = U.dot(Vt)
+    norm = np.square(Xr - mx).sum()
+    scale = s.sum() / norm if norm > 0 else 1.0
+    return scale * (X - mx).dot(R) + my
+
+# the transform of a 2-d layout X that puts one or two of its rows where they were
+# in Y: one chart fixes a translation, two also fix a rotation and uniform scale
+# (without reflection); align needs at least three
+def align_few(X, Y, rows):
+    Xr = X[rows]
+    if len(rows) == 1:
+        return X - Xr[0] + Y[0]
+
+    a = complex(*(Xr[1] - Xr[0]))
+    b = complex(*(Y[1] - Y[0]))
+    z = b / a if abs(a) > 0 else 1.0
+    moved = (X[:, 0] - Xr[0, 0] + 1j * (X[:, 1] - Xr[0, 1])) * z
+    return np.stack([moved.real, moved.imag], axis=1) + Y[0]
+
+# lay out charts from their dissimilarities, reusing the previous coordinates of
+# charts that were already placed; new charts start where their distances to the
+# placed ones put them, and the result is returned in the frame of the prior layout
+def incremental_layout(dissimilarities, ids, prev_ids=(), prev_coords=(), max_iter=3000, eps=1e-6):
+    D = np.asarray(dissimilarities, dtype=np.float64)
+    prev = dict(zip(prev_ids, prev_coords))
+    known = [i for i, chid in enumerate(ids) if chid in prev]
+    new = [i for i, chid in enumerate(ids) if chid not in prev]
+
+    if len(known) == 0:
+        X, stress, iterations = smacof(D, classical_mds(D), max_iter, eps)
+        return X, stress, iterations
+
+    Y = np.array([prev[ids[i]] for i in known], dtype=np.float64)
+    if len(known) < 3:
+        X, stress, iterations = smacof(D, classical_mds(D), max_iter, eps)
+        return align_few(X, Y, known), stress, iterations
+
+    # the prior layout may be at any scale, so bring it to the scale of D first
+    dp = np.sqrt(np.square(Y[:, None, :] - Y[None, :, :]).sum(axis=-1))
+    dk = D[np.ix_(known, known)]
+    scale = (dp * dk).sum() / np.square(dp).sum() if np.square(dp).sum() > 0 else 1.0
+
+    init = np.zeros((D.shape[0], Y.shape[1]))
+    init[known] = Y * scale
+    if len(new) > 0:
+        init[new] = inverse_mds(init[known], D[np.ix_(new, known)])
+
+    X, stress, iterations = smacof(D, init, max_iter, eps)
+    return align(X, Y, known), stress, iterations
+
+# average-linkage clustering cut where merges exceed threshold, as clusterfck.hcluster
+# does on the client; returns a cluster index per chart
+def hierarchical_clusters(distances, threshold):
+    if distances.shape[0] < 2:
+        return np.zeros(distances.shape[0], dtype=int)
+    from scipy.spatial.distance import squareform
+    from scipy.cluster.hierarchy import linkage, fcluster
+    Z = linkage(squareform(distances, checks=False), method='average')
+    return fcluster(Z, t=threshold, criterion='distance') - 1
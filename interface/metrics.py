@@ -0,0 +1,204 @@
+import bisect
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+
+# cumulative-bucket histogram in the style of Prometheus
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = []
+            total = 0
+            for le, c in zip(self.buckets + ['+Inf'], self.counts):
+                total += c
+                cumulative.append((le, total))
+            return {'buckets': cumulative, 'sum': self.sum, 'count': self.count}
+
+class Counter():
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+# a metric and its children, one per combination of label values, created on
+# first use; observations only touch their child, so families cost nothing until
+# they are rendered
+class Family():
+    def __init__(self, name, help, kind, labelnames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, Histogram(self.buckets) if self.kind == 'histogram' else Counter())
+        return child
+
+    # an existing metric as the child of the given label values
+    def attach(self, values, child):
+        with self._lock:
+            self._children[tuple(values)] = child
+
+    # [labels, value] of every child, a histogram's value being its snapshot
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        return [[list(zip(self.labelnames, values)), child.snapshot() if self.kind == 'histogram' else child.value]
+            for values, child in children]
+
+class Registry():
+    def __init__(self):
+        self.families = []
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Family(name, help, 'counter', labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=()):
+        return self._add(Family(name, help, 'histogram', labelnames, buckets))
+
+    # the families and values read at scrape time, given as (name, type, help,
+    # [(labels, value)]), as plain data that render_snapshot formats and that can
+    # be written to a file: {name: {'kind', 'help', 'samples': [[labels, value]]}}
+    def snapshot(self, collected=()):
+        result = collections.OrderedDict()
+        for family in self.families:
+            result[family.name] = {'kind': family.kind, 'help': family.help, 'samples': family.samples()}
+        for name, kind, help, samples in collected:
+            result[name] = {'kind': kind, 'help': help, 'samples': [[list(labels), value] for labels, value in samples]}
+        return result
+
+    # the Prometheus text exposition format
+    def render(self, collected=()):
+        return render_snapshot(self.snapshot(collected))
+
+    def _add(self, family):
+        self.families.append(family)
+        return family
+
+def render_snapshot(snapshot):
+    lines = []
+    for name, metric in snapshot.items():
+        lines.extend(['# HELP %s %s' % (name, metric['help']), '# TYPE %s %s' % (name, metric['kind'])])
+        for labels, value in metric['samples']:
+            labels = [tuple(l) for l in labels]
+            if metric['kind'] == 'histogram':
+                for le, count in value['buckets']:
+                    lines.append('%s_bucket%s %d' % (name, format_labels(labels + [('le', format_value(le))]), count))
+                lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(value['sum'])))
+                lines.append('%s_count%s %d' % (name, format_labels(labels), value['count']))
+            else:
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+# snapshots of several processes, given as (pid, snapshot, live), as one:
+# counters and histograms are summed over all of them, exited ones included, so
+# totals never go back when a worker is replaced; gauges stay per process, for
+# the live ones, with a pid label
+def merge_snapshots(snapshots):
+    merged = collections.OrderedDict()
+    for pid, snapshot, live in snapshots:
+        for name, metric in snapshot.items():
+            into = merged.setdefault(name, {'kind': metric['kind'], 'help': metric['help'], 'samples': collections.OrderedDict()})
+            for labels, value in metric['samples']:
+                key = tuple(tuple(l) for l in labels)
+                if metric['kind'] == 'gauge':
+                    if live:
+                        pid_label = () if 'pid' in dict(key) else (('pid', str(pid)),)
+                        into['samples'][key + pid_label] = value
+                else:
+                    into['samples'][key] = add_values(into['samples'].get(key), value)
+
+    for metric in merged.values():
+        metric['samples'] = [[list(labels), value] for labels, value in sorted(metric['samples'].items())]
+    return merged
+
+def add_values(a, b):
+    if a is None:
+        return b
+    if isinstance(b, dict):
+        return {'buckets': [(le, x + y) for (le, x), (_, y) in zip(a['buckets'], b['buckets'])],
+            'sum': a['sum'] + b['sum'], 'count': a['count'] + b['count']}
+    return a + b
+
+# snapshots of the workers of a pre-forked server, one file per process in a
+# directory they share; each worker rewrites its own every interval seconds and
+# when it serves a scrape, and files of exited workers are kept for their counts
+class SharedSnapshots():
+    def __init__(self, path, interval=1.0):
+        self.path = path
+        self.interval = interval
+
+    def write(self, snapshot):
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'w') as outputs:
+            json.dump(snapshot, outputs, default=lambda v: v.item())
+        os.rename(tmp, os.path.join(self.path, '%d.json' % os.getpid()))
+
+    # rewrites this process' file from collect() in a daemon thread
+    def start(self, collect):
+        def run():
+            while True:
+                time.sleep(self.interval)
+                self.write(collect())
+        thread = threading.Thread(target=run, name='metrics-writer')
+        thread.daemon = True
+        thread.start()
+
+    def read(self):
+        snapshots = []
+        for filename in sorted(os.listdir(self.path)):
+            pid, ext = os.path.splitext(filename)
+            if ext != '.json' or not pid.isdigit():
+                continue
+            try:
+                with open(os.path.join(self.path, filename), 'r') as inputs:
+                    snapshots.append((int(pid), json.load(inputs), is_live(int(pid))))
+            except (IOError, ValueError):
+                # removed while listing
+                continue
+        return snapshots
+
+def is_live(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in labels)
+
+def format_value(value):
+    if isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
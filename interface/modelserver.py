@@ -1,32 +1,65 @@
+import time
+started = time.perf_counter()
+
 import simplejson as json
 import os, sys, re
-from multiprocessing import Pool
-import nltk
+import argparse
+import atexit
+import contextlib
+import shutil
+import tempfile
+import threading
+import uuid
 import numpy as np
-from scipy.optimize import minimize
-from scipy.spatial import procrustes
-import h5py
-
-from keras import backend as K
-import tensorflow as tf
-
-from sklearn.decomposition import PCA
-from sklearn.manifold import MDS, smacof
 
-from flask import Flask, jsonify, request
+# TensorFlow, Keras, sklearn, scipy and h5py are imported where they are first needed,
+# so startup only loads what serving uses and the timing report can tell them apart
+from flask import Flask, Response, g, has_request_context, jsonify as flask_jsonify, request
 from flask_cors import CORS
 
-from gvaemodel.vis_vae import VisVAE, get_rules, get_specs
+from gvaemodel.vis_vae import VisVAE, get_rules, DECODE_MODES, ENGINES
 from gvaemodel.vis_grammar import VisGrammar
+from gvaemodel.cache import LRUCache
+from layout import inverse_mds, incremental_layout, chart_distances, hierarchical_clusters
+from sessions import SessionStore
+from batching import MicroBatcher
+from neighbors import NeighborIndex, load_store, line_offsets
+from prefork import PreforkServer
+from metrics import Registry, SharedSnapshots, merge_snapshots, render_snapshot
+import transport
+from transport import JSON, FLOAT32, MSGPACK
 
+# seconds spent in each startup phase, printed when the server is ready and
+# reported by /stats
+startup = {'imports': time.perf_counter() - started}
+
+host = '127.0.0.1'
 port = 5000
 rulesfile = './gvaemodel/rules-cfg.txt'
 modelsave = './gvaemodel/vae_H256_D256_C444_333_L20_B200.hdf5'
+grammarcache = './gvaemodel/compiled/'
 
 m = re.search(r'_L(\d+)_', modelsave)
 
 MAX_LEN = 20
 LATENT = int(m.group(1))
+ENCODE_CACHE_SIZE = 10000
+DECODE_CACHE_SIZE = 10000
+DECODE_QUANTUM = 1e-3
+SESSION_TTL = 3600
+MAX_SESSIONS = 1000
+SESSION_MEMORY = 512
+RECOMMEND_BATCH = 8
+BATCH_WINDOW = 5
+MAX_BATCH = 256
+RECOMMEND_ATTEMPTS = 5
+NEIGHBORS_K = 10
+MAX_BEAM_WIDTH = 64
+CORPUS_CHUNK = 1024
+METRICS_INTERVAL = 1.0
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+BYTES_BUCKETS = [2**k for k in range(6, 27, 2)]
+ROWS_BUCKETS = [2**k for k in range(13)]
 
 # rules = []
 # with open(rulesfile, 'r') as inputs:
@@ -39,14 +72,139 @@ LATENT = int(m.group(1))
 
 # pca = PCA(n_components=2)
 
+rules = None
+weights = None
+shared_seconds = 0.0
+grammar = None
 visvae = None
 graph = None
 sess = None
-pca = None
+sessions = SessionStore(SESSION_TTL, MAX_SESSIONS, SESSION_MEMORY * 2**20)
+model_lock = threading.Lock()
+batchers = {}
+neighbor_index = None
 
 app = Flask(__name__)
 CORS(app)
 
+# request and stage metrics of this process, rendered only when /metrics is
+# scraped; with --workers the workers also write them to shared_metrics, and a
+# scrape merges those of all workers
+metrics = Registry()
+shared_metrics = None
+request_seconds = metrics.histogram('chartseer_request_seconds', 'Request latency from routing to response.',
+    ('endpoint',), LATENCY_BUCKETS)
+stage_seconds = metrics.histogram('chartseer_stage_seconds', 'Time spent in each stage of a request.',
+    ('endpoint', 'stage'), LATENCY_BUCKETS)
+request_bytes = metrics.histogram('chartseer_request_bytes', 'Request body size.', ('endpoint',), BYTES_BUCKETS)
+response_bytes = metrics.histogram('chartseer_response_bytes', 'Response body size.', ('endpoint',), BYTES_BUCKETS)
+batch_rows = metrics.histogram('chartseer_batch_rows', 'Rows per call of a model stage.', ('endpoint', 'stage'), ROWS_BUCKETS)
+requests_total = metrics.counter('chartseer_requests_total', 'Requests by endpoint and status code.', ('endpoint', 'status'))
+model_errors_total = metrics.counter('chartseer_model_errors_total', 'Failed encoder or decoder calls by exception type.',
+    ('endpoint', 'error'))
+batcher_rows = metrics.histogram('chartseer_batcher_rows', 'Rows per batched predict.', ('model',), ROWS_BUCKETS)
+batcher_queue = metrics.histogram('chartseer_batcher_queue_depth', 'Requests waiting when a batch is formed.', ('model',))
+
+def current_endpoint():
+    if has_request_context():
+        return g.get('endpoint', 'unmatched')
+    return 'none'
+
+@contextlib.contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.labels(current_endpoint(), name).observe(time.perf_counter() - start)
+
+# fn timed as a stage of the calling request; rows also records the size of its
+# first argument
+def timed(name, fn, rows=False):
+    def run(x, *args, **kwargs):
+        if rows:
+            batch_rows.labels(current_endpoint(), name).observe(len(x))
+        with stage(name):
+            return fn(x, *args, **kwargs)
+    return run
+
+# in beam mode _sample_indices runs _beam_indices, which is timed as a stage of
+# its own
+def sampling_stage(sample_indices):
+    timed_sampling = timed('mask sampling', sample_indices)
+    def run(unmasked, mode='sample', seed=None):
+        if mode == 'beam':
+            return sample_indices(unmasked, mode, seed)
+        return timed_sampling(unmasked, mode, seed)
+    return run
+
+def jsonify(*args, **kwargs):
+    with stage('json serialization'):
+        return flask_jsonify(*args, **kwargs)
+
+inverse_mds = timed('inverse mds', inverse_mds)
+incremental_layout = timed('layout', incremental_layout)
+chart_distances = timed('distances', chart_distances)
+hierarchical_clusters = timed('clustering', hierarchical_clusters)
+
+# endpoints are labelled by route, so the label set stays bounded; the body is
+# parsed here as a stage of its own and handlers get the cached result
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    g.endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    if request.content_length:
+        request_bytes.labels(g.endpoint).observe(request.content_length)
+    if request.is_json:
+        with stage('json parsing'):
+            request.get_json(silent=True)
+    elif request.mimetype in (FLOAT32, MSGPACK):
+        read_body()
+
+# the request body as JSON (the default), raw float32 or msgpack; arrays of the
+# binary formats are read-only views of the request bytes
+def read_body():
+    if 'body' not in g:
+        mimetype = request.mimetype
+        if mimetype == MSGPACK and transport.msgpack is None:
+            raise InvalidUsage('msgpack is not installed on the server', status_code=415)
+        try:
+            if mimetype == FLOAT32:
+                with stage('float32 parsing'):
+                    g.body = transport.load_float32(request.get_data())
+            elif mimetype == MSGPACK:
+                with stage('msgpack parsing'):
+                    g.body = transport.load_msgpack(request.get_data())
+            else:
+                g.body = request.get_json()
+        except ValueError as e:
+            raise InvalidUsage('cannot read %s body: %s' % (mimetype, e))
+    return g.body
+
+# the result in the format the Accept header prefers: a float array as raw
+# float32, anything as msgpack, or JSON by default
+def respond(result):
+    offered = [JSON, FLOAT32, MSGPACK] if transport.msgpack is not None else [JSON, FLOAT32]
+    mimetype = request.accept_mimetypes.best_match(offered, default=JSON)
+    if mimetype == FLOAT32 and isinstance(result, np.ndarray) and result.dtype.kind == 'f':
+        with stage('float32 serialization'):
+            return Response(transport.dump_float32(result), mimetype=FLOAT32)
+    if mimetype == MSGPACK:
+        with stage('msgpack serialization'):
+            return Response(transport.dump_msgpack(result), mimetype=MSGPACK)
+    with stage('json serialization'):
+        return flask_jsonify(transport.to_lists(result))
+
+@app.after_request
+def finish_request(response):
+    endpoint = g.get('endpoint', 'unmatched')
+    requests_total.labels(endpoint, str(response.status_code)).inc()
+    if response.content_length is not None:
+        response_bytes.labels(endpoint).observe(response.content_length)
+    if 'started' in g:
+        request_seconds.labels(endpoint).observe(time.perf_counter() - g.started)
+    return response
+
 
 class InvalidUsage(Exception):
     status_code = 400
@@ -71,94 +229,564 @@ def handle_invalid_usage(error):
 
 @app.route('/encode', methods=['POST'])
 def encode():
-    specs = request.get_json()
+    specs = read_body()
+    z = encode_specs(specs)
+    return respond(z)
+
+def encode_specs(specs):
+    return run_model(visvae.encode, specs)
+
+def run_model(fn, *args, **kwargs):
     try:
-        with graph.as_default():
-            tf.keras.backend.set_session(sess)
-            z = visvae.encode(specs)
+        return fn(*args, **kwargs)
     except Exception as e:
-        raise InvalidUsage(e.message)
-    return jsonify(z.tolist())
+        model_errors_total.labels(current_endpoint(), type(e).__name__).inc()
+        raise InvalidUsage(str(e))
+
+# the Keras models are shared by all threads, so network calls run one at a time
+# in the model graph
+def in_graph(fn):
+    import tensorflow as tf
+
+    def run(x):
+        with model_lock, graph.as_default():
+            tf.keras.backend.set_session(sess)
+            return fn(x)
+    return run
+
+# state of the session named by the X-Session-Id header or the session query
+# parameter; clients that send neither share the 'default' session. None when the
+# server runs with --no-sessions
+def get_session():
+    if sessions is None:
+        return None
+    sid = request.headers.get('X-Session-Id') or request.args.get('session') or 'default'
+    return sessions.get(sid)
+
+# for requests that only work on state kept by an earlier one
+def require_session(what):
+    session = get_session()
+    if session is None:
+        raise InvalidUsage(what + ' needs session state, and this server runs with --no-sessions', status_code=409)
+    return session
+
+def get_previous(inputdata, session):
+    prev = inputdata.get('previous')
+    if prev is None and session is not None and session.layout is not None:
+        return session.layout['ids'], session.layout['coords']
+    prev = prev or {}
+    return prev.get('ids', []), prev.get('coords', [])
+
+def store_layout(session, ids, z, coords):
+    if session is None:
+        return
+    values = {'layout': {'ids': list(ids), 'coords': np.asarray(coords)}}
+    if z is not None:
+        values['embeddings'] = {'ids': list(ids), 'z': np.asarray(z)}
+    sessions.put(session, **values)
+
+def store_distances(session, distm):
+    if session is None:
+        return None
+    handle = uuid.uuid4().hex
+    sessions.put_distances(session, handle, distm)
+    return handle
 
 @app.route('/decode', methods=['POST'])
 def decode():
-    z = np.array(request.get_json())
-    try:
-        with graph.as_default():
-            tf.keras.backend.set_session(sess)
-            specs = visvae.decode(z)
-    except Exception as e:
-        raise InvalidUsage(e.message)
-    return jsonify(specs)
+    # either a list of latent vectors or {"z": [...], "mode": ..., "seed": ...};
+    # mode "beam" with "k" returns the k best specs of every vector and their
+    # log-probabilities, {"specs": [[...]], "scores": [[...]]}
+    inputdata = read_body()
+    k = None
+    if isinstance(inputdata, dict):
+        z = np.array(inputdata['z'])
+        mode = inputdata.get('mode', 'sample')
+        seed = inputdata.get('seed')
+        k = inputdata.get('k')
+    else:
+        z = np.array(inputdata)
+        mode, seed = 'sample', None
+    if mode not in DECODE_MODES:
+        raise InvalidUsage('unknown decode mode: ' + str(mode))
+
+    if mode == 'beam' and k is not None:
+        if not is_count(k) or k > MAX_BEAM_WIDTH:
+            raise InvalidUsage('k must be between 1 and %d' % MAX_BEAM_WIDTH)
+        specs, scores = run_model(visvae.decode_beam, z, k, as_json=False)
+        return respond({'specs': specs, 'scores': scores})
+
+    specs = run_model(visvae.decode, z, as_json=False, mode=mode, seed=seed)
+    return respond(specs)
+
+@app.route('/project', methods=['POST'])
+def project():
+    # {"specs": [...] or "embeddings": [...], "vars": [[...], ...], "distw": w,
+    #  "ids": [...], "previous": {"ids": [...], "coords": [...]}}
+    inputdata = read_body()
+    session = get_session()
+    timings = {}
+
+    start = time.perf_counter()
+    if 'embeddings' in inputdata:
+        z = np.array(inputdata['embeddings'], dtype=np.float32)
+    else:
+        z = encode_specs(inputdata['specs'])
+    timings['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    distm = chart_distances(z, inputdata['vars'], inputdata['distw'])
+    handle = store_distances(session, distm)
+    timings['distances'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    prev_ids, prev_coords = get_previous(inputdata, session)
+    y, stress, iterations = incremental_layout(distm, inputdata['ids'], prev_ids, prev_coords)
+    store_layout(session, inputdata['ids'], z, y)
+    timings['layout'] = time.perf_counter() - start
+
+    # stage timings are reported in milliseconds
+    return respond({'embeddings': z, 'coords': y, 'handle': handle,
+        'stress': stress, 'iterations': iterations,
+        'timings': {k: v * 1000 for k, v in timings.items()}})
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    result = {}
+    if visvae.encode_cache is not None:
+        result['encode_cache'] = visvae.encode_cache.stats()
+    if visvae.decode_cache is not None:
+        result['decode_cache'] = visvae.decode_cache.stats()
+    for name, batcher in batchers.items():
+        result[name + '_batcher'] = batcher.stats()
+    if sessions is not None:
+        result['sessions'] = sessions.stats()
+    if neighbor_index is not None:
+        result['neighbors'] = neighbor_index.stats()
+    result['startup'] = startup
+    return jsonify(result)
+
+# Prometheus text format: the request metrics plus cache, session and startup
+# figures read at scrape time
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    snapshot = collect_metrics()
+    if shared_metrics is not None:
+        shared_metrics.write(snapshot)
+        snapshot = merge_snapshots(shared_metrics.read())
+    return Response(render_snapshot(snapshot), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+def collect_metrics():
+    collected = [('chartseer_worker_info', 'gauge', 'Serving process, one per live worker with --workers.', [([('pid', os.getpid())], 1)])]
+    caches = [(name, cache.stats()) for name, cache in [('encode', visvae.encode_cache), ('decode', visvae.decode_cache)]
+        if cache is not None]
+    collected.append(('chartseer_cache_entries', 'gauge', 'Entries in a cache.', [([('cache', n)], c['size']) for n, c in caches]))
+    collected.append(('chartseer_cache_hits_total', 'counter', 'Cache hits.', [([('cache', n)], c['hits']) for n, c in caches]))
+    collected.append(('chartseer_cache_misses_total', 'counter', 'Cache misses.', [([('cache', n)], c['misses']) for n, c in caches]))
+
+    if sessions is not None:
+        session_stats = sessions.stats()
+        collected.append(('chartseer_sessions', 'gauge', 'Live sessions.', [([], session_stats['sessions'])]))
+        collected.append(('chartseer_session_bytes', 'gauge', 'Memory held by session state.', [([], session_stats['bytes'])]))
+        collected.append(('chartseer_session_evictions_total', 'counter', 'Sessions dropped for age or memory.', [([], session_stats['evictions'])]))
+    if neighbor_index is not None:
+        index_stats = neighbor_index.stats()
+        collected.append(('chartseer_neighbor_charts', 'gauge', 'Charts in the neighbor index.',
+            [([('part', 'tree')], index_stats['indexed']), ([('part', 'buffer')], index_stats['buffered'])]))
+    collected.append(('chartseer_startup_seconds', 'gauge', 'Time spent in each startup phase.',
+        [([('phase', phase)], t) for phase, t in startup.items()]))
+    return metrics.snapshot(collected)
+
+@app.route('/neighbors', methods=['POST'])
+def neighbors():
+    # {"z": [...] or "specs": [...], "k": N, "include_specs": true}, the k nearest
+    # corpus and inserted charts of every query; charts inserted since the last
+    # tree rebuild are compared one by one, at most neighbors.MIN_REBUILD or
+    # neighbors.REBUILD_FRACTION of the indexed ones
+    inputdata = read_body()
+    index = get_neighbor_index()
+    k = inputdata.get('k', NEIGHBORS_K)
+    if not is_count(k):
+        raise InvalidUsage('k must be a positive integer')
+    z = get_embeddings(inputdata)
+    with stage('neighbor search'):
+        dists, ids = index.query(z, k)
+
+    result = {'ids': ids, 'distances': dists}
+    if inputdata.get('include_specs', True):
+        with stage('spec lookup'):
+            result['specs'] = [index.specs(row) for row in ids]
+    return respond(result)
+
+@app.route('/neighbors/add', methods=['POST'])
+def add_neighbors():
+    # {"specs": [...], optionally with their "z"}; inserted charts live in this
+    # process only
+    inputdata = read_body()
+    index = get_neighbor_index()
+    specs = [json.loads(s) if isinstance(s, str) else s for s in inputdata['specs']]
+    z = get_embeddings(inputdata)
+    return respond({'ids': index.add(z, specs)})
+
+# a positive integer; JSON true is not one
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+def get_neighbor_index():
+    if neighbor_index is None:
+        raise InvalidUsage('no corpus index, start the server with --corpus')
+    return neighbor_index
+
+def get_embeddings(inputdata):
+    if 'z' in inputdata:
+        return np.array(inputdata['z'], dtype=np.float32)
+    specs = [s if isinstance(s, str) else json.dumps(s) for s in inputdata['specs']]
+    return encode_specs(specs)
+
+# the --corpus index: a store written by gvae/embed.py is used as is, a spec
+# file is embedded here, skipping lines the model cannot encode
+def load_corpus(path):
+    if os.path.isfile(path + '.json'):
+        z, offsets, ids, source = load_store(path)
+        return NeighborIndex(z[ids], ids, source, offsets)
+
+    offsets = line_offsets(path)
+    ids, objs, zs = [], [], []
+    with open(path, 'r') as inputs:
+        for i, line in enumerate(inputs):
+            try:
+                obj = json.loads(line)
+                spec_rules = []
+                get_rules(obj, 'root', spec_rules)
+            except Exception:
+                continue
+            if len(spec_rules) <= MAX_LEN and all(r in visvae.rule2index for r in spec_rules):
+                ids.append(i)
+                objs.append(obj)
+    for start in range(0, len(objs), CORPUS_CHUNK):
+        zs.append(visvae.encoder_predict(visvae._one_hot(objs[start:start + CORPUS_CHUNK])))
+    z = np.concatenate(zs) if zs else np.zeros((0, LATENT), dtype=np.float32)
+    return NeighborIndex(z, ids, path, offsets)
 
 @app.route('/orientate', methods=['POST'])
 def orientate():
-    locations = request.get_json()
-    mt1, mt2, disparity = procrustes(locations[0], locations[1]) 
-    return jsonify(mt2.tolist())
+    locations = read_body()
+    from scipy.spatial import procrustes
+    with stage('procrustes'):
+        mt1, mt2, disparity = procrustes(locations[0], locations[1]) 
+    return respond(mt2)
 
 @app.route('/pca', methods=['POST'])
 def pcaproject():
-    global pca
+    from sklearn.decomposition import PCA
     pca = PCA(n_components=2)
-    x = np.array(request.get_json())
-    y = pca.fit_transform(x)
-    return jsonify(y.tolist())
+    x = np.array(read_body())
+    with stage('pca'):
+        y = pca.fit_transform(x)
+    session = get_session()
+    if session is not None:
+        sessions.put(session, pca=pca)
+    return respond(y)
 
 @app.route('/invpca', methods=['POST'])
 def invpcaproject():
-    global pca
-    y = np.array(request.get_json())
-    x = pca.inverse_transform(y)
-    return jsonify(x.tolist())
+    pca = require_session('/invpca').pca
+    if pca is None:
+        raise InvalidUsage('no PCA model in this session, call /pca first')
+    y = np.array(read_body())
+    with stage('pca'):
+        x = pca.inverse_transform(y)
+    return respond(x)
+
+@app.route('/distances', methods=['POST'])
+def distances():
+    # {"embeddings": [...], "vars": [[...], ...], "distw": w}, keeps the matrix
+    # under a handle that /mds, /layout and /cluster accept in its place
+    inputdata = read_body()
+    distm = chart_distances(inputdata['embeddings'], inputdata['vars'], inputdata['distw'])
+    handle = store_distances(get_session(), distm)
+
+    result = {'handle': handle, 'size': distm.shape[0]}
+    if inputdata.get('matrix', False):
+        result['distances'] = distm
+    return respond(result)
+
+def get_distances(inputdata):
+    if isinstance(inputdata, dict) and 'handle' in inputdata:
+        distm = require_session('a distance handle').distances.get(inputdata['handle'])
+        if distm is None:
+            raise InvalidUsage('unknown distance handle: ' + str(inputdata['handle']), status_code=404)
+        return distm
+    if isinstance(inputdata, dict) and 'embeddings' in inputdata:
+        return chart_distances(inputdata['embeddings'], inputdata['vars'], inputdata['distw'])
+    if isinstance(inputdata, dict):
+        return np.array(inputdata['distances'])
+    return np.array(inputdata)
+
+@app.route('/cluster', methods=['POST'])
+def cluster():
+    # {"threshold": t} with the matrix as a "handle", as "distances" or as the
+    # "embeddings", "vars" and "distw" of /distances
+    inputdata = read_body()
+    distm = get_distances(inputdata)
+    clusters = hierarchical_clusters(distm, inputdata['threshold'])
+    return respond(clusters)
 
 @app.route('/mds', methods=['POST'])
 def mdsproject():
-    distm = np.array(request.get_json())
+    distm = get_distances(read_body())
+    from sklearn.manifold import MDS
     mds = MDS(n_components=2, dissimilarity='precomputed', random_state=13, max_iter=3000, eps=1e-9)
-    y = mds.fit(distm).embedding_
+    with stage('mds'):
+        y = mds.fit(distm).embedding_
     # res = smacof(distm, n_components=2, random_state=13, max_iter=3000, eps=1e-9)
     # y = res[0]    
-    return jsonify(y.tolist())
+    return respond(y)
+
+@app.route('/layout', methods=['POST'])
+def layoutproject():
+    # {"ids": [...], "distances": n x n or "handle": h, "previous": {"ids": [...], "coords": [...]}},
+    # without "previous" the session's last layout is the prior
+    inputdata = read_body()
+    session = get_session()
+    distm = get_distances(inputdata)
+    prev_ids, prev_coords = get_previous(inputdata, session)
+    y, stress, iterations = incremental_layout(distm, inputdata['ids'], prev_ids, prev_coords)
+    store_layout(session, inputdata['ids'], None, y)
+    return respond({'coords': y, 'stress': stress, 'iterations': iterations})
+
+@app.route('/recommend', methods=['POST'])
+def recommend():
+    # {"points": chart embeddings, "distances": m x n target distances, "num": N,
+    # "mode": "sample" or "beam"}
+    inputdata = read_body()
+    ps = np.array(inputdata['points'])
+    dsall = np.array(inputdata['distances'])
+    num = inputdata.get('num', dsall.shape[0])
+    mode = inputdata.get('mode', 'sample')
+    if mode not in ('sample', 'beam'):
+        raise InvalidUsage('unknown recommend mode: ' + str(mode))
+
+    z = inverse_mds(ps, dsall).astype(np.float32)
+    unmasked = run_model(visvae.decode_logits, z)
+
+    if mode == 'beam':
+        slots = recommend_beams(unmasked, num)
+    else:
+        slots = recommend_specs(unmasked, num)
+    return respond({'specs': [spec for _, spec in slots],
+        'embeddings': z[[i for i, _ in slots]].reshape(len(slots), -1),
+        'indices': [i for i, _ in slots]})
+
+# sample specs for every target, keeping those with data variables that were not
+# seen before; only rejected slots are sampled again, a few at a time, from the
+# decoder outputs already computed
+def recommend_specs(unmasked, num, batch=RECOMMEND_BATCH, attempts=RECOMMEND_ATTEMPTS):
+    seen = set()
+    accepted = {}
+    tries = np.zeros(unmasked.shape[0], dtype=int)
+    pending = list(range(unmasked.shape[0]))
+
+    while len(pending) > 0 and len(accepted) < num:
+        # the first round covers every target, later rounds only retry
+        rows = pending if tries.max() == 0 else pending[:batch]
+        pending = pending[len(rows):]
+        tries[rows] += 1
+
+        for i, spec in zip(rows, visvae.sample_specs(unmasked[rows], as_json=False)):
+            key = json.dumps(spec, sort_keys=True)
+            if has_variables(spec) and key not in seen and len(accepted) < num:
+                seen.add(key)
+                accepted[i] = spec
+            elif tries[i] < attempts:
+                pending.append(i)
+
+    return sorted(accepted.items())
+
+# the most likely spec of every target that has data variables and was not seen
+# before, searched among its beams in order; deterministic, and a single pass
+def recommend_beams(unmasked, num, k=RECOMMEND_ATTEMPTS):
+    seen = set()
+    accepted = []
+    candidates, _ = visvae.beam_specs(unmasked, k, as_json=False)
+    for i, specs in enumerate(candidates):
+        if len(accepted) >= num:
+            break
+        for spec in specs:
+            key = json.dumps(spec, sort_keys=True)
+            if has_variables(spec) and key not in seen:
+                seen.add(key)
+                accepted.append((i, spec))
+                break
+
+    return accepted
+
+def has_variables(node):
+    if isinstance(node, dict):
+        return any(has_variables(v) for v in node.values())
+    return node in ('num', 'str')
 
 @app.route('/invmds', methods=['POST'])
 def invmdsproject():
-    inputdata = request.get_json()
+    inputdata = read_body()
     ps = np.array(inputdata['points'])
     dsall = np.array(inputdata['distances'])
-    
-    #res = myminimize((ps, dsall[0]))
-    pool = Pool(8)
-    res = pool.map(myminimize, [(ps, ds) for ds in dsall])
-    res = [r.tolist() for r in res]
-    pool.close()
-    pool.join()
-    return jsonify(res)
-
-def myminimize(args):
-    ps, ds = args
-    x0 = np.random.random_sample(ps[0].shape)
-    res = minimize(objfun, x0, args=(ps, ds), tol=1e-9, options={'maxiter':3000})
-    return res.x
-
-def objfun(x, ps, ds):
-    d = np.tile(x, (ps.shape[0], 1)) - ps
-    d = np.sum(np.square(d), axis=1)
-    diff = np.sqrt(d) - ds
-    return np.sum(np.square(diff))
 
-if __name__ == '__main__':
+    res = inverse_mds(ps, dsall)
+    return respond(res)
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='ChartSeer recommendation engine')
+
+    parser.add_argument('--host', default=host)
+    parser.add_argument('--port', type=int, metavar='N', default=port)
+    parser.add_argument('--workers', type=int, metavar='N', default=0,
+        help='number of pre-forked worker processes, 0 serves from this process')
+    parser.add_argument('--engine', choices=ENGINES, default='keras',
+        help='numpy runs the model without TensorFlow')
+    parser.add_argument('--cache-size', type=int, metavar='N', default=ENCODE_CACHE_SIZE,
+        help='number of spec embeddings kept in memory, 0 to disable the cache')
+    parser.add_argument('--cache-file', metavar='PATH', default=None,
+        help='file that keeps cached embeddings across restarts')
+    parser.add_argument('--decode-cache-size', type=int, metavar='N', default=DECODE_CACHE_SIZE,
+        help='number of greedy/seeded/beam decodings kept in memory, 0 to disable the cache')
+    parser.add_argument('--decode-quantum', type=float, metavar='Q', default=DECODE_QUANTUM,
+        help='grid step that latent vectors are rounded to before a cached decode')
+    parser.add_argument('--session-ttl', type=int, metavar='SECONDS', default=SESSION_TTL)
+    parser.add_argument('--max-sessions', type=int, metavar='N', default=MAX_SESSIONS)
+    parser.add_argument('--session-memory', type=int, metavar='MB', default=SESSION_MEMORY,
+        help='memory for session state, least recently used sessions are dropped beyond it')
+    parser.add_argument('--no-sessions', dest='sessions', action='store_false',
+        help='keep no state between requests (/invpca, distance handles, the last layout); required with more than one worker')
+    parser.add_argument('--batch-window', type=float, metavar='MS', default=BATCH_WINDOW,
+        help='time to gather concurrent encode/decode requests into one predict, 0 to disable')
+    parser.add_argument('--max-batch', type=int, metavar='N', default=MAX_BATCH,
+        help='rows that trigger a batched predict before the window ends')
+    parser.add_argument('--grammar-cache', metavar='DIR', default=grammarcache,
+        help='directory of compiled grammars, built on first start; empty to parse the rules with nltk every time')
+    parser.add_argument('--corpus', metavar='PATH', default=None,
+        help='charts for /neighbors: an embedding store of gvae/embed.py or a spec file to embed at startup')
+
+    return parser.parse_args()
+
+# read-only state loaded once; with --workers it is shared by all workers
+def load_shared(args):
+    global rules, weights, grammar, neighbor_index, started, shared_seconds
+
+    # a SIGHUP reload is timed from its own start, not from the first imports
+    if rules is not None:
+        started = time.perf_counter()
+        startup.clear()
+
+    start = time.perf_counter()
     rules = []
     with open(rulesfile, 'r') as inputs:
         for line in inputs:
             line = line.strip()
             rules.append(line)
+    grammar = VisGrammar(rules, cache_dir=args.grammar_cache or None)
+    startup['grammar'] = time.perf_counter() - start
 
-    sess = tf.Session()
-    tf.keras.backend.set_session(sess)
-    visvae = VisVAE(modelsave, rules, MAX_LEN, LATENT)
-    graph = tf.get_default_graph()
+    # a precomputed store needs no model, so its index is shared by the workers
+    if args.corpus and os.path.isfile(args.corpus + '.json'):
+        start = time.perf_counter()
+        neighbor_index = load_corpus(args.corpus)
+        startup['corpus index'] = time.perf_counter() - start
 
-    pca = PCA(n_components=2)
+    start = time.perf_counter()
+    from gvaemodel.weights import read_weights
+    weights = read_weights(modelsave)
+    startup['weight read'] = time.perf_counter() - start
+    shared_seconds = time.perf_counter() - started
+
+# per-process state: TensorFlow sessions and threads do not survive a fork
+def init_worker(args):
+    global sess, visvae, graph, sessions, neighbor_index, shared_metrics
+    forked = time.perf_counter()
+
+    encode_cache = None
+    if args.cache_size > 0:
+        # shelve files cannot be shared between processes
+        cache_file = args.cache_file if args.workers <= 1 else None
+        encode_cache = LRUCache(args.cache_size, cache_file, namespace=os.path.basename(modelsave))
+        atexit.register(encode_cache.close)
+    decode_cache = None
+    if args.decode_cache_size > 0:
+        decode_cache = LRUCache(args.decode_cache_size)
+
+    if args.engine == 'keras':
+        start = time.perf_counter()
+        import tensorflow as tf
+        import gvaemodel.model_vae
+        startup['tensorflow import'] = time.perf_counter() - start
+
+    # only the inference networks are built, from the weights read in load_shared
+    start = time.perf_counter()
+    if args.engine == 'keras':
+        sess = tf.Session()
+        tf.keras.backend.set_session(sess)
+    visvae = VisVAE(modelsave, rules, MAX_LEN, LATENT, encode_cache=encode_cache, decode_cache=decode_cache,
+        decode_quantum=args.decode_quantum, weights=weights, grammar=grammar, inference=True, engine=args.engine)
+    startup['model build'] = time.perf_counter() - start
+
+    # the numpy engine keeps no state between calls, so it needs neither the lock
+    # nor the graph
+    if args.engine == 'keras':
+        graph = tf.get_default_graph()
+        visvae.encoder_predict = in_graph(visvae.encoder_predict)
+        visvae.decoder_predict = in_graph(visvae.decoder_predict)
+    if args.batch_window > 0:
+        batchers['encode'] = MicroBatcher(visvae.encoder_predict, args.batch_window / 1000.0, args.max_batch)
+        batchers['decode'] = MicroBatcher(visvae.decoder_predict, args.batch_window / 1000.0, args.max_batch)
+        visvae.encoder_predict = batchers['encode'].submit
+        visvae.decoder_predict = batchers['decode'].submit
+        for name, batcher in batchers.items():
+            batcher_rows.attach((name,), batcher.batch_size)
+            batcher_queue.attach((name,), batcher.queue_depth)
+
+    # stages of encode and decode; the network calls include any batching wait
+    visvae.encoder_predict = timed('encoder predict', visvae.encoder_predict, rows=True)
+    visvae.decoder_predict = timed('decoder predict', visvae.decoder_predict, rows=True)
+    visvae._one_hot = timed('one-hot', visvae._one_hot)
+    visvae._sample_indices = sampling_stage(visvae._sample_indices)
+    visvae._beam_indices = timed('beam search', visvae._beam_indices)
+    visvae.spec_builder.build = timed('spec building', visvae.spec_builder.build)
+
+    sessions = SessionStore(args.session_ttl, args.max_sessions, args.session_memory * 2**20) if args.sessions else None
+
+    if args.corpus and neighbor_index is None:
+        start = time.perf_counter()
+        neighbor_index = load_corpus(args.corpus)
+        startup['corpus index'] = time.perf_counter() - start
+
+    # workers may start long after load_shared (a reload replaces them one at a
+    # time, a crashed one is restarted), so only their own time is added to it
+    startup['total'] = shared_seconds + time.perf_counter() - forked
+
+    if args.workers > 0:
+        shared_metrics = SharedSnapshots(args.metrics_dir, METRICS_INTERVAL)
+        shared_metrics.start(collect_metrics)
+
+    print('process %d ready: ' % os.getpid() + ', '.join('%s %.0f ms' % (phase, t * 1000) for phase, t in startup.items()))
+
+if __name__ == '__main__':
+    args = get_arguments()
 
-    app.run(port=port, debug=False)
+    if args.workers > 0:
+        # a request may reach any worker, and each would keep its own sessions
+        if args.sessions and args.workers > 1:
+            sys.exit('session state is kept per worker: run more than one worker with --no-sessions')
+        if args.cache_file and args.workers > 1:
+            print('--cache-file is ignored with more than one worker')
+        if args.engine == 'keras' and args.workers > 1:
+            print('with the keras engine every worker builds its own copy of the model; --engine numpy shares one')
+        # kept across reloads, so counts of replaced workers stay in the totals
+        args.metrics_dir = tempfile.mkdtemp(prefix='chartseer-metrics-')
+        atexit.register(shutil.rmtree, args.metrics_dir, True)
+        server = PreforkServer(app, args.host, args.port, args.workers,
+            preload=lambda: load_shared(args), post_fork=lambda: init_worker(args))
+        server.serve()
+    else:
+        load_shared(args)
+        init_worker(args)
+        app.run(host=args.host, port=args.port, debug=False, threaded=True)
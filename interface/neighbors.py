@@ -0,0 +1,148 @@
+import threading
+import simplejson as json
+import numpy as np
+
+# points inserted since the last build are searched linearly; the tree is
+# rebuilt once they exceed this many, or this fraction of the indexed points
+MIN_REBUILD = 1024
+REBUILD_FRACTION = 0.125
+
+# byte offset of the start of every line, plus the file size as the end of the last
+def line_offsets(filename, block=16 * 2**20):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    position = 0
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(block)
+            if not data:
+                break
+            newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+            offsets.append(position + newlines.astype(np.int64) + 1)
+            position += len(data)
+    offsets = np.concatenate(offsets)
+    if offsets[-1] != position:
+        offsets = np.append(offsets, position)
+    return offsets
+
+# scipy is only loaded with the first index, not when the server starts
+def build_tree(points):
+    from scipy.spatial import cKDTree
+    return cKDTree(points)
+
+# a store written by gvae/embed.py: embeddings, line offsets into the source
+# file and the status of every row (1 for embedded)
+def load_store(prefix):
+    with open(prefix + '.json', 'r') as inputs:
+        meta = json.load(inputs)
+    z = np.load(prefix + '.z.npy', mmap_mode='r')
+    offsets = np.load(prefix + '.offsets.npy')
+    status = np.load(prefix + '.status.npy', mmap_mode='r')
+    return z, offsets, np.flatnonzero(status == 1), meta['source']
+
+# k-nearest-neighbour search over chart embeddings: a KD-tree over the corpus
+# plus a linearly searched buffer of charts inserted at runtime, folded into the
+# tree once it holds more than MIN_REBUILD or REBUILD_FRACTION of the indexed
+# charts, so its share of a query stays bounded. Corpus specs
+# stay in their source file and are read by line offset when returned; ids are
+# corpus line numbers, followed by inserted charts in order
+class NeighborIndex():
+    def __init__(self, z, ids, source=None, offsets=None):
+        self.source = source
+        self.offsets = offsets
+        self.next_id = int(offsets.shape[0] - 1) if offsets is not None else len(ids)
+        self.rebuilds = 0
+
+        self._points = np.asarray(z, dtype=np.float64)
+        self._ids = np.asarray(ids, dtype=np.int64)
+        self._tree = build_tree(self._points) if len(self._ids) > 0 else None
+        # the buffer grows by doubling, so a query reads a view of its filled rows
+        self._added_z = np.zeros((0, self._points.shape[1] if self._points.ndim == 2 else 0))
+        self._added_ids = np.zeros(0, dtype=np.int64)
+        self._added = 0
+        self._added_specs = {}
+        self._lock = threading.Lock()
+
+    # distances and ids of the k nearest charts to every row of z
+    def query(self, z, k):
+        z = np.atleast_2d(np.asarray(z, dtype=np.float64))
+        with self._lock:
+            tree, tree_ids = self._tree, self._ids
+            added_z = self._added_z[:self._added]
+            added_ids = self._added_ids[:self._added]
+
+        k = min(k, len(tree_ids) + len(added_ids))
+        if k == 0:
+            return np.zeros((z.shape[0], 0)), np.zeros((z.shape[0], 0), dtype=np.int64)
+
+        dists = np.zeros((z.shape[0], 0))
+        ids = np.zeros((z.shape[0], 0), dtype=np.int64)
+        if tree is not None:
+            kt = min(k, len(tree_ids))
+            d, ix = tree.query(z, k=kt)
+            dists, ids = d.reshape(z.shape[0], kt), tree_ids[ix.reshape(z.shape[0], kt)]
+        if len(added_ids) > 0:
+            d = np.sqrt(np.square(z[:, None, :] - added_z[None, :, :]).sum(axis=-1))
+            dists = np.concatenate([dists, d], axis=1)
+            ids = np.concatenate([ids, np.broadcast_to(added_ids, d.shape)], axis=1)
+
+        order = np.argsort(dists, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(dists, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    # insert charts, returning their ids
+    def add(self, z, specs):
+        z = np.atleast_2d(np.asarray(z, dtype=np.float64))
+        with self._lock:
+            ids = list(range(self.next_id, self.next_id + z.shape[0]))
+            self.next_id += z.shape[0]
+            end = self._added + z.shape[0]
+            if end > self._added_ids.shape[0] or self._added_z.shape[1] != z.shape[1]:
+                self._grow(max(end, 2 * self._added_ids.shape[0]), z.shape[1])
+            # rows past the views that queries took, so they are written in place
+            self._added_z[self._added:end] = z
+            self._added_ids[self._added:end] = ids
+            self._added = end
+            self._added_specs.update(zip(ids, specs))
+
+            if self._added > max(MIN_REBUILD, REBUILD_FRACTION * len(self._ids)):
+                self._rebuild()
+        return ids
+
+    def specs(self, ids):
+        specs = []
+        f = open(self.source, 'rb') if self.source is not None else None
+        try:
+            for chid in ids:
+                chid = int(chid)
+                if chid in self._added_specs:
+                    specs.append(self._added_specs[chid])
+                else:
+                    f.seek(self.offsets[chid])
+                    line = f.read(self.offsets[chid + 1] - self.offsets[chid]).decode('utf8').rstrip('\r\n')
+                    specs.append(json.loads(line))
+        finally:
+            if f is not None:
+                f.close()
+        return specs
+
+    def stats(self):
+        with self._lock:
+            return {'indexed': len(self._ids), 'buffered': self._added, 'rebuilds': self.rebuilds}
+
+    # new arrays, so views held by running queries stay as they were
+    def _grow(self, capacity, dim):
+        added_z = np.zeros((capacity, dim))
+        added_ids = np.zeros(capacity, dtype=np.int64)
+        added_z[:self._added] = self._added_z[:self._added]
+        added_ids[:self._added] = self._added_ids[:self._added]
+        self._added_z, self._added_ids = added_z, added_ids
+
+    # queries that started before a rebuild keep using the old tree and buffer
+    def _rebuild(self):
+        dim = self._added_z.shape[1]
+        self._points = np.concatenate([self._points.reshape(-1, dim), self._added_z[:self._added]])
+        self._ids = np.concatenate([self._ids, self._added_ids[:self._added]])
+        self._tree = build_tree(self._points)
+        self._added_z = np.zeros((0, dim))
+        self._added_ids = np.zeros(0, dtype=np.int64)
+        self._added = 0
+        self.rebuilds += 1
@@ -0,0 +1,134 @@
+import errno
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+# pre-forking WSGI server: the master binds the socket and runs preload once, so
+# everything it loads is shared copy-on-write by the forked workers; post_fork
+# runs in each worker for state that cannot cross a fork (sessions, threads).
+# SIGHUP runs preload again and replaces the workers one at a time, SIGTERM and
+# SIGINT stop them after their in-flight requests
+class PreforkServer():
+    def __init__(self, app, host, port, workers, preload=None, post_fork=None, timeout=30):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.preload = preload
+        self.post_fork = post_fork
+        self.timeout = timeout
+
+        self._pids = set()
+        self._stopping = False
+        self._reloading = False
+
+    def serve(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(128)
+        self.sock.set_inheritable(True)
+
+        if self.preload is not None:
+            self.preload()
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, '_reloading', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, '_stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, '_stopping', True))
+
+        for _ in range(self.workers):
+            self._spawn()
+        print('master %d serving on %s:%d with %d workers' % (os.getpid(), self.host, self.port, self.workers))
+
+        while not self._stopping:
+            self._reap(respawn=True)
+            if self._reloading:
+                self._reloading = False
+                self._reload()
+            time.sleep(0.2)
+
+        self._stop_workers(list(self._pids))
+        self.sock.close()
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                self._run_worker()
+            except BaseException:
+                import traceback
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        self._pids.add(pid)
+        return pid
+
+    def _run_worker(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        if self.post_fork is not None:
+            self.post_fork()
+
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.sock.fileno())
+        # let in-flight requests finish on shutdown
+        server.daemon_threads = False
+        server.block_on_close = True
+
+        # shutdown() waits for serve_forever, so it cannot run in the signal handler
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        server.serve_forever()
+        server.server_close()
+
+    def _reload(self):
+        print('master %d reloading' % os.getpid())
+        if self.preload is not None:
+            self.preload()
+        for pid in list(self._pids):
+            self._spawn()
+            self._stop_workers([pid])
+
+    def _reap(self, respawn):
+        for pid in list(self._pids):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError as e:
+                if e.errno != errno.ECHILD:
+                    raise
+                done = pid
+            if done == pid:
+                self._pids.discard(pid)
+                if respawn and not self._stopping:
+                    print('worker %d exited, starting a new one' % pid, file=sys.stderr)
+                    self._spawn()
+
+    def _stop_workers(self, pids):
+        for pid in pids:
+            self._signal(pid, signal.SIGTERM)
+
+        deadline = time.time() + self.timeout
+        while any(pid in self._pids for pid in pids) and time.time() < deadline:
+            self._reap(respawn=False)
+            time.sleep(0.1)
+
+        for pid in pids:
+            if pid in self._pids:
+                self._signal(pid, signal.SIGKILL)
+                self._pids.discard(pid)
+                try:
+                    os.waitpid(pid, 0)
+                except OSError:
+                    pass
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
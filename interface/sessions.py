@@ -0,0 +1,108 @@
+import collections
+import threading
+import time
+
+from gvaemodel.cache import LRUCache
+
+SESSION_HANDLES = 4
+
+# projection state of one analyst: the PCA model of /pca, the last layout, the
+# embeddings it was computed from and recent distance matrices by handle. State
+# is changed through SessionStore.put and put_distances, which account for its size
+class Session():
+    def __init__(self, sid):
+        self.sid = sid
+        self.pca = None
+        self.layout = None
+        self.embeddings = None
+        self.distances = LRUCache(SESSION_HANDLES)
+        self.last_access = time.time()
+        self.size = 0
+
+    def nbytes(self):
+        total = sum(d.nbytes for d in self.distances.values())
+        if self.embeddings is not None:
+            total += self.embeddings['z'].nbytes
+        if self.layout is not None:
+            total += self.layout['coords'].nbytes
+        if self.pca is not None:
+            total += self.pca.components_.nbytes + self.pca.mean_.nbytes
+        return total
+
+# sessions keyed by a client-supplied id; sessions idle for longer than ttl
+# seconds are dropped, and beyond maxsessions or maxbytes the least recently used
+# ones go first. The sessions are kept in order of last access and their bytes
+# as a running total, so a request costs time in the sessions it drops, not in
+# all of them
+class SessionStore():
+    def __init__(self, ttl=3600, maxsessions=1000, maxbytes=512 * 2**20):
+        self.ttl = ttl
+        self.maxsessions = maxsessions
+        self.maxbytes = maxbytes
+        self.evictions = 0
+        self._sessions = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            session = self._sessions.get(sid)
+            if session is None:
+                session = Session(sid)
+                self._sessions[sid] = session
+            self._sessions.move_to_end(sid)
+            session.last_access = time.time()
+            self._evict(keep=sid)
+            return session
+
+    # set state of a session, e.g. put(session, pca=pca), and drop other
+    # sessions if it takes the store over maxbytes
+    def put(self, session, **values):
+        with self._lock:
+            for name, value in values.items():
+                setattr(session, name, value)
+            self._resize(session)
+
+    def put_distances(self, session, handle, distm):
+        with self._lock:
+            session.distances.put(handle, distm)
+            self._resize(session)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'bytes': self._bytes, 'evictions': self.evictions}
+
+    # a session dropped while a request still held it is no longer counted
+    def _resize(self, session):
+        size = session.nbytes()
+        if self._sessions.get(session.sid) is session:
+            self._bytes += size - session.size
+            session.size = size
+            self._evict(keep=session.sid)
+
+    def _evict(self, keep):
+        # the least recently used sessions come first, so expired ones are at the front
+        now = time.time()
+        while self._sessions:
+            sid, session = next(iter(self._sessions.items()))
+            if sid == keep or now - session.last_access <= self.ttl:
+                break
+            self._remove(sid)
+
+        while len(self._sessions) > self.maxsessions:
+            self._pop_oldest(keep)
+
+        while self._bytes > self.maxbytes and len(self._sessions) > 1:
+            self._pop_oldest(keep)
+
+    def _pop_oldest(self, keep):
+        sid = next(iter(self._sessions))
+        if sid == keep:
+            self._sessions.move_to_end(sid)
+            sid = next(iter(self._sessions))
+        self._remove(sid)
+
+    def _remove(self, sid):
+        session = self._sessions.pop(sid)
+        self._bytes -= session.size
+        self.evictions += 1
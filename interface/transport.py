@@ -0,0 +1,72 @@
+import struct
+import numpy as np
+
+# msgpack is optional; without it only JSON and raw float32 bodies are served
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON = 'application/json'
+FLOAT32 = 'application/x-float32'
+MSGPACK = 'application/msgpack'
+
+# numeric types an array may have in a msgpack body
+ARRAY_KINDS = 'biuf'
+
+# a raw float32 body is a little-endian uint32 ndim, ndim uint32 dimensions and
+# the little-endian float32 values in C order; parsing wraps the request bytes
+# without copying them
+def load_float32(data):
+    if len(data) < 4:
+        raise ValueError('float32 body without a shape header')
+    ndim = struct.unpack_from('<I', data)[0]
+    offset = 4 * (1 + ndim)
+    if len(data) < offset:
+        raise ValueError('float32 body with a truncated shape header')
+    shape = struct.unpack_from('<%dI' % ndim, data, 4)
+    count = int(np.prod(shape, dtype=np.int64))
+    if len(data) != offset + 4 * count:
+        raise ValueError('float32 body of %d bytes does not match shape %s' % (len(data), list(shape)))
+    return np.frombuffer(data, dtype='<f4', count=count, offset=offset).reshape(shape)
+
+def dump_float32(a):
+    a = np.ascontiguousarray(a, dtype='<f4')
+    return struct.pack('<%dI' % (1 + a.ndim), a.ndim, *a.shape) + a.tobytes()
+
+# msgpack bodies have the structure of the JSON ones, except that any array may
+# be a map {"shape": [...], "dtype": "<f4", "data": <bin>} of its raw values;
+# responses send float arrays that way as float32
+def load_msgpack(data):
+    return msgpack.unpackb(data, raw=False, object_hook=_load_array)
+
+def dump_msgpack(obj):
+    return msgpack.packb(obj, use_bin_type=True, default=_dump_array)
+
+def _load_array(obj):
+    if set(obj.keys()) != {'shape', 'dtype', 'data'}:
+        return obj
+    dtype = np.dtype(obj['dtype'])
+    if dtype.kind not in ARRAY_KINDS:
+        raise ValueError('unsupported array dtype: ' + obj['dtype'])
+    return np.frombuffer(obj['data'], dtype=dtype).reshape(obj['shape'])
+
+def _dump_array(obj):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.kind == 'f':
+            obj = obj.astype('<f4', copy=False)
+        obj = np.ascontiguousarray(obj)
+        return {'shape': list(obj.shape), 'dtype': obj.dtype.str, 'data': obj.tobytes()}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError('cannot serialize %s' % type(obj).__name__)
+
+# arrays anywhere in a response as nested lists, for JSON
+def to_lists(obj):
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return {k: to_lists(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [to_lists(v) for v in obj]
+    return obj